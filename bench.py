@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+#
+# mkresults benchmarks.
+#
+#  Builds a synthetic race database with mksynth.py and times each
+#  case against it.  Every case runs in its own process, so the peak
+#  RSS that is reported belongs to that case alone.
+#
+#  --suite runs the whole of mkresults, in a few output modes, at
+#  several field sizes.  The figures can be recorded, and compared
+#  with an earlier recording to catch regressions.
+#   ./bench.py --suite --record base.json
+#   ./bench.py --suite --baseline base.json
+#
+import sys, argparse
+import json
+import sqlite3
+import os, time
+import resource
+import shutil, subprocess, tempfile
+from collections import namedtuple
+import mkresults
+import binresults
+
+global args
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+#
+# pos and rider as they were before the columnar store: plain classes,
+# with an attribute dict per instance.  mkresults' own classes have
+# __slots__ now, so the objects case keeps these copies to go on
+# measuring the old loader.
+#
+class old_pos():
+    def __init__(self, v):
+        self.time_ms    = v[0]
+        self.line_id    = v[1]
+        self.forward    = v[2]
+        self.meters     = v[3]
+        self.mwh        = v[4]
+        self.duration   = v[5]
+        self.elevation  = v[6]
+        self.speed      = float((v[7] or 0) / 1000)     # meters/hour
+        self.hr         = v[8]
+
+
+class old_rider():
+    def __init__(self, id):
+        self.id         = id
+        self.pos        = []
+        self.fname      = 'Rider'
+        self.lname      = str(id)
+        self.cat        = 'X'
+        self.weight     = 0
+        self.height     = 0
+        self.age        = 0
+        self.male       = False
+        self._power     = 0
+        self.power      = '?'
+        self.name       = self.fname + ' ' + self.lname
+        self.has_info   = False
+
+        self.finish     = []
+        self.end_time   = None
+        self.dq_time    = None
+        self.dq_reason  = None
+        self.distance   = None
+
+        self.points     = 0
+        self.end        = None
+
+
+#
+# Loader used before the columnar store: one pos instance per
+# record, plus a (pos, rider) tuple in all_pos.
+#
+def objects_get_riders(begin_ms, end_ms):
+    R = {}
+    all_pos = []
+    c = mkresults.dbh.cursor()
+    for data in c.execute('select rider_id, time_ms, line_id, forward,' +
+            ' meters, mwh, duration, elevation, speed, hr from pos' +
+            ' where time_ms between ? and ? order by time_ms asc',
+            (begin_ms, end_ms)):
+        id = data[0]
+        if not id in R:
+            R[id] = old_rider(id)
+        position = old_pos(data[1:])
+        R[id].pos.append(position)
+        all_pos.append((position, R[id]))
+    return R, all_pos
+
+
+def case_objects(conf):
+    R, all_pos = objects_get_riders(conf.start_ms - conf.lookback_ms,
+            conf.finish_ms)
+    return { 'riders': len(R), 'records': len(all_pos) }
+
+
+def case_columns(conf):
+    R = mkresults.get_riders(conf.start_ms - conf.lookback_ms, conf.finish_ms)
+    return { 'riders': len(R),
+            'records': sum([ len(r.pos) for r in R.values() ]) }
+
+
+#
+# Rider records for the whole window, with names for the starters.
+#
+def case_riders(conf):
+    R = mkresults.get_riders(conf.start_ms - conf.lookback_ms, conf.finish_ms)
+    F = [ r for r in R.values() if mkresults.filter_start(r) ]
+    mkresults.rider_info(F)
+    return { 'riders': len(R),
+            'records': sum([ len(r.pos) for r in R.values() ]) }
+
+
+#
+# A pos instance for every record in the window, all held at once.
+#
+def case_pos(conf):
+    R = mkresults.get_riders(conf.start_ms - conf.lookback_ms, conf.finish_ms)
+    P = [ list(r.pos) for r in R.values() ]
+    return { 'riders': len(R), 'records': sum([ len(L) for L in P ]) }
+
+
+#
+# Per-rider stages up to grp_finish, with every rider resident.
+#
+def case_resident(conf):
+    R = mkresults.get_riders(conf.start_ms - conf.lookback_ms, conf.finish_ms)
+    records = sum([ len(r.pos) for r in R.values() ])
+    F = [ r for r in R.values() if mkresults.filter_start(r) ]
+    [ mkresults.trim_course(r) for r in F ]
+    [ mkresults.trim_crash(r) for r in F ]
+    mkresults.set_grp_start(R)
+    for grp in conf.grp:
+        [ mkresults.grp_finish(r, grp) for r in F ]
+    return { 'riders': len(F), 'records': records }
+
+
+#
+# The same stages, streaming one rider at a time.
+#
+def case_stream(conf):
+    F = mkresults.stream_riders(conf.start_ms - conf.lookback_ms,
+            conf.finish_ms)
+    return { 'riders': len(F), 'records': sum([ len(r.pos) for r in F ]) }
+
+
+CASES = [
+    ('objects', case_objects, 'get_riders, one pos object per record'),
+    ('columns', case_columns, 'get_riders, columnar position store'),
+    ('riders', case_riders, 'get_riders, starters and their names'),
+    ('pos', case_pos, 'get_riders, then a pos object for every record'),
+    ('resident', case_resident, 'start .. finish stages, all riders loaded'),
+    ('stream', case_stream, 'start .. finish stages, one rider at a time'),
+]
+
+
+#
+# Loading the results of a race, as the web front end does for every
+# page: all of the result records, but not the crossings.
+#
+def load_json(fname):
+    f = open(fname)
+    race = json.load(f)
+    f.close()
+    return { 'results': sum([ len(g['results']) for g in race['group'] ]) }
+
+
+def load_binary(fname):
+    f = binresults.reader(fname)
+    for n in xrange(f.n_groups):
+        f.results(n)
+    return { 'results': f.n_results }
+
+
+#
+# Everything, crossings included, back into the JSON structure.
+#
+def load_tree(fname):
+    f = binresults.reader(fname)
+    race = f.tree()
+    return { 'results': sum([ len(g['results']) for g in race['group'] ]) }
+
+
+LOADS = [
+    ('json', load_json, '.json', 'json.load of the -j -s output'),
+    ('binary', load_binary, '.bin', 'binresults, all result records'),
+    ('bin-tree', load_tree, '.bin', 'binresults, full tree with crossings'),
+]
+
+
+def measure(f, *v):
+    t0 = time.time()
+    c0 = time.clock()
+    result = f(*v)
+    result['wall'] = time.time() - t0
+    result['cpu'] = time.clock() - c0
+
+    # ru_maxrss is in kilobytes on Linux, bytes on Mac.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss / 1024
+    result['maxrss_kb'] = rss
+    print json.dumps(result)
+
+
+#
+# Child process: run a single case and report on stdout.
+#
+def run_case(name):
+    if name in [ l[0] for l in LOADS ]:
+        measure(dict([ (l[0], l[1]) for l in LOADS ])[name], args.file)
+        return
+
+    mkresults.args = namedtuple('Args', 'no_cat debug split shards')(
+            no_cat=False, debug=False, split=False, shards=1)
+    mkresults.dbh = sqlite3.connect(args.database)
+    mkresults.name_dbh = sqlite3.connect(os.path.join(
+            os.path.dirname(os.path.abspath(args.database)),
+            'rider_names.sql3'))
+    conf = mkresults.config(args.config)
+    mkresults.conf = conf
+    conf.load_chalklines()
+
+    measure(dict([ (c[0], c[1]) for c in CASES ])[name], conf)
+
+
+def spawn(name, *v):
+    out = subprocess.check_output([ sys.executable, __file__,
+            '--case', name ] + list(v))
+    return json.loads(out)
+
+
+#
+# Write the -j -s and --binary results next to the database, returns
+# the file name, without extension.
+#
+def make_results(database, config):
+    out = subprocess.check_output([ sys.executable,
+            os.path.join(HERE, 'mkresults.py'), '-j', '-s', '-r',
+            '--binary', '--database', os.path.abspath(database),
+            os.path.abspath(config) ],
+            cwd = os.path.dirname(os.path.abspath(database)))
+    for line in out.splitlines():
+        if line.startswith('Writing results to '):
+            fname = line[len('Writing results to '):]
+            return os.path.join(os.path.dirname(os.path.abspath(database)),
+                    os.path.splitext(fname)[0])
+    sys.exit('mkresults did not write results: %s' % out)
+
+
+def make_db(dir, riders, laps, *v):
+    database = os.path.join(dir, 'race_database.sql3')
+    config = os.path.join(dir, 'race.conf')
+    subprocess.check_call([ sys.executable,
+            os.path.join(HERE, 'mksynth.py'),
+            '-n', str(riders), '-l', str(laps),
+            '--names', os.path.join(dir, 'rider_names.sql3'),
+            '--config', config, database ] + list(v))
+    return database, config
+
+
+#
+# Full mkresults runs.  The races have a few crashes, early starters
+# and wrong-course riders, so the DQ paths are timed too.
+#
+SUITE = [
+    ('text', [ '-i' ]),
+    ('json', [ '-j', '-s' ]),
+    ('stream', [ '-j', '--stream' ]),
+]
+SUITE_INCIDENTS = [ '--crashes', '0.02', '--early', '0.05',
+        '--wrong-course', '0.02' ]
+
+# runs shorter than this are all noise.
+SUITE_MIN_WALL = 0.05
+
+
+#
+# One mkresults run, with its own --profile-json for the figures.
+#
+def run_mkresults(dir, config, opts):
+    fname = os.path.join(dir, 'profile.json')
+    null = open(os.devnull, 'w')
+    subprocess.check_call([ sys.executable,
+            os.path.join(HERE, 'mkresults.py'), '--profile-json', fname ] +
+            opts + [ os.path.abspath(config) ], cwd = dir, stdout = null)
+    null.close()
+    f = open(fname)
+    prof = json.load(f)
+    f.close()
+    return prof
+
+
+def regressed(r, base):
+    if base is None:
+        return []
+    slow = []
+    if (r['wall'] > base['wall'] * (1 + args.tolerance)) and \
+            (r['wall'] - base['wall'] > SUITE_MIN_WALL):
+        slow.append('wall %.3f -> %.3f' % (base['wall'], r['wall']))
+    if (r['maxrss_kb'] > base['maxrss_kb'] * (1 + args.tolerance)):
+        slow.append('maxrss %d -> %d KB' % (base['maxrss_kb'],
+                r['maxrss_kb']))
+    return slow
+
+
+def run_suite():
+    baseline = {}
+    if args.baseline:
+        f = open(args.baseline)
+        for r in json.load(f):
+            baseline[(r['riders'], r['mode'])] = r
+        f.close()
+
+    records = []
+    regressions = []
+    print '%-8s %-8s %9s %8s %8s %10s' % (
+            'riders', 'mode', 'records', 'wall', 'cpu', 'maxrss KB')
+    for riders in [ int(n) for n in args.scales.split(',') ]:
+        tmp = tempfile.mkdtemp(prefix='zbench')
+        try:
+            (database, config) = make_db(tmp, riders, args.laps,
+                    *SUITE_INCIDENTS)
+            for (mode, opts) in SUITE:
+                prof = run_mkresults(tmp, config, opts)
+                t = prof['total']
+                r = { 'riders': riders, 'mode': mode, 'wall': t['wall'],
+                        'cpu': t['cpu'], 'maxrss_kb': t['maxrss_kb'],
+                        'records': max([ s['rows'] or 0
+                        for s in prof['stages'] ]),
+                        'stages': dict([ (s['stage'], s['wall'])
+                        for s in prof['stages'] ]) }
+                records.append(r)
+                slow = regressed(r, baseline.get((riders, mode)))
+                print '%-8d %-8s %9d %8.3f %8.3f %10d  %s' % (riders, mode,
+                        r['records'], r['wall'], r['cpu'], r['maxrss_kb'],
+                        ', '.join(slow))
+                if slow:
+                    regressions.append('%d %s' % (riders, mode))
+        finally:
+            shutil.rmtree(tmp)
+
+    if args.record:
+        f = open(args.record, 'w')
+        json.dump(records, f, indent = 1)
+        f.write('\n')
+        f.close()
+    if regressions:
+        sys.exit('regressions: %s' % '; '.join(regressions))
+
+
+def main(argv):
+    global args
+
+    parser = argparse.ArgumentParser(description = 'mkresults benchmarks')
+    parser.add_argument('-n', '--riders', type=int, default=2000,
+            help='Synthetic rider count')
+    parser.add_argument('-l', '--laps', type=int, default=4,
+            help='Synthetic race length in laps')
+    parser.add_argument('--case', help='Run a single case (internal)')
+    parser.add_argument('--database', help='Use existing race database')
+    parser.add_argument('--config', help='Race config for --database')
+    parser.add_argument('--file', help='Results file for a load case')
+    parser.add_argument('--suite', action='store_true',
+            help='Time full mkresults runs at several field sizes')
+    parser.add_argument('--scales', default='100,1000,10000',
+            help='Rider counts for --suite')
+    parser.add_argument('--record', help='Save the --suite figures as JSON')
+    parser.add_argument('--baseline',
+            help='Compare --suite with figures saved by --record')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+            help='Fraction of slowdown or growth to allow over --baseline')
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args.case)
+        return
+    if args.suite:
+        run_suite()
+        return
+
+    tmp = None
+    if args.database:
+        (database, config) = (args.database, args.config)
+    else:
+        tmp = tempfile.mkdtemp(prefix='zbench')
+        (database, config) = make_db(tmp, args.riders, args.laps)
+
+    try:
+        print '%-10s %8s %9s %8s %8s %10s' % (
+                'case', 'riders', 'records', 'wall', 'cpu', 'maxrss KB')
+        for (name, f, desc) in CASES:
+            r = spawn(name, '--database', database, '--config', config)
+            print '%-10s %8d %9d %8.3f %8.3f %10d' % (name, r['riders'],
+                    r['records'], r['wall'], r['cpu'], r['maxrss_kb'])
+
+        base = make_results(database, config)
+        print
+        print '%-10s %8s %9s %8s %8s %10s' % (
+                'load', 'results', 'size KB', 'wall', 'cpu', 'maxrss KB')
+        for (name, f, ext, desc) in LOADS:
+            r = spawn(name, '--file', base + ext)
+            print '%-10s %8d %9d %8.3f %8.3f %10d' % (name, r['results'],
+                    os.path.getsize(base + ext) / 1024, r['wall'], r['cpu'],
+                    r['maxrss_kb'])
+        for ext in ('.json', '.bin'):
+            os.unlink(base + ext)
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except KeyboardInterrupt:
+        pass
+    except SystemExit, se:
+        print "ERROR:", se
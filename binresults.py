@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+#
+# Binary race results.
+#
+#  A fixed-width form of the mkresults JSON output, written by
+#  `mkresults.py --binary'.  The reader memory-maps the file and only
+#  unpacks the records that are asked for, so nothing has to be parsed
+#  up front.
+#   ./binresults.py SYN.2016-07-07.bin
+#   ./binresults.py SYN.2016-07-07.bin --check SYN.2016-07-07.json
+#
+#  Layout, all little endian:
+#   header
+#   crossings   CROSS records, each rider's crossings are contiguous
+#   results     RESULT records, each group's results are contiguous
+#   groups      GROUP records
+#   strings     n + 1 offsets into the string data, then the data (utf-8)
+#
+#  Strings are stored once and referred to by index, NONE is None.
+#  Integers which may be NULL use the smallest value of their type.
+#
+import sys, argparse
+import json
+import mmap
+import struct
+from collections import namedtuple
+
+MAGIC   = 'ZRES'
+VERSION = 1
+
+NONE    = 0xffffffff                    # string index of None
+NULL_I  = -2 ** 31
+NULL_Q  = -2 ** 63
+
+HAS_CROSS = 0x01                        # result has crossings (-s)
+
+HEADER = struct.Struct('<4sHHIIIIQQQQQI4x')
+GROUP  = struct.Struct('<IIII')
+RESULT = struct.Struct('<qiiIIIIBB2xIIiiiiiqqqqqdQI4x')
+CROSS  = struct.Struct('<qqqqdiiB7x')
+OFFSET = struct.Struct('<II')
+
+group  = namedtuple('group', 'name sprints first count')
+result = namedtuple('result', 'id height weight fname lname cat power male' +
+        ' flags timepos est_cat pos watts points beg_hr end_hr meters mwh' +
+        ' duration start_msec end_msec wkg cross_first cross_count')
+cross  = namedtuple('cross', 'time_ms meters mwh duration speed line hr' +
+        ' forward')
+
+# string and nullable fields of each record, by position.
+RESULT_STR  = (3, 4, 5, 6, 9, 10)
+RESULT_NULL = dict([ (n, NULL_I) for n in (1, 2, 11, 12, 13, 14, 15) ] +
+        [ (n, NULL_Q) for n in (0, 16, 17, 18, 19, 20) ])
+CROSS_NULL  = dict([ (n, NULL_Q) for n in (0, 1, 2, 3) ] +
+        [ (n, NULL_I) for n in (5, 6) ])
+
+
+def null(v, sentinel):
+    return sentinel if v is None else v
+
+
+#
+# Writes a results file from the groups that mkresults.json_cat()
+# builds.  Crossings go straight to the file, the (small) result,
+# group and string tables are written by close().
+#
+class writer():
+    def __init__(self, fname, race, date):
+        self.f          = open(fname, 'wb')
+        self.index      = {}
+        self.strings    = []
+        self.groups     = []
+        self.results    = []
+        self.n_cross    = 0
+        self.race       = self.string(race)
+        self.date       = self.string(date)
+        self.f.write('\0' * HEADER.size)
+
+    def string(self, s):
+        if s is None:
+            return NONE
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        idx = self.index.get(s)
+        if idx is None:
+            idx = self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return idx
+
+    def group(self, g):
+        first = len(self.results)
+        for entry in g['results']:
+            self.result(entry)
+        self.groups.append(GROUP.pack(self.string(g['name']),
+                self.string(json.dumps(g['sprints'])),
+                first, len(self.results) - first))
+
+    def result(self, entry):
+        r = entry['rider']
+        f = entry['finish']
+        first = self.n_cross
+        flags = 0
+        if 'cross' in entry:
+            flags = flags | HAS_CROSS
+            B = [ CROSS.pack(null(c['time_ms'], NULL_Q),
+                    null(c['meters'], NULL_Q), null(c['mwh'], NULL_Q),
+                    null(c['duration'], NULL_Q), c['speed'],
+                    null(c['line'], NULL_I), null(c['hr'], NULL_I),
+                    1 if c['forward'] else 0) for c in entry['cross'] ]
+            self.f.write(''.join(B))
+            self.n_cross = self.n_cross + len(B)
+        self.results.append(RESULT.pack(null(r['id'], NULL_Q),
+                null(r['height'], NULL_I), null(r['weight'], NULL_I),
+                self.string(r['fname']), self.string(r['lname']),
+                self.string(r['cat']), self.string(r['power']),
+                1 if r['male'] else 0, flags,
+                self.string(f['timepos']), self.string(f['est_cat']),
+                null(f['pos'], NULL_I), null(f['watts'], NULL_I),
+                null(f['points'], NULL_I), null(f['beg_hr'], NULL_I),
+                null(f['end_hr'], NULL_I), null(f['meters'], NULL_Q),
+                null(f['mwh'], NULL_Q), null(f['duration'], NULL_Q),
+                null(f['start_msec'], NULL_Q), null(f['end_msec'], NULL_Q),
+                f['wkg'], first, self.n_cross - first))
+
+    def close(self):
+        off_results = self.f.tell()
+        self.f.write(''.join(self.results))
+        off_groups = self.f.tell()
+        self.f.write(''.join(self.groups))
+        off_strings = self.f.tell()
+        offsets = [ 0 ]
+        for s in self.strings:
+            offsets.append(offsets[-1] + len(s))
+        self.f.write(struct.pack('<%dI' % len(offsets), *offsets))
+        self.f.write(''.join(self.strings))
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, VERSION, 0, self.race, self.date,
+                len(self.groups), len(self.results), self.n_cross,
+                HEADER.size, off_results, off_groups, off_strings,
+                len(self.strings)))
+        self.f.close()
+
+
+#
+# Memory-mapped results file.
+#  group(n), result(n) and crossings(rec) unpack single records;
+#  entry(n) and tree() rebuild the same structure as the JSON output.
+#
+class reader():
+    def __init__(self, fname):
+        self.f = open(fname, 'rb')
+        self.m = mmap.mmap(self.f.fileno(), 0, access = mmap.ACCESS_READ)
+        if (len(self.m) < HEADER.size) or (self.m[0:4] != MAGIC):
+            raise ValueError('%s: not a binary results file' % fname)
+        (magic, version, flags, self.race_idx, self.date_idx,
+                self.n_groups, self.n_results, self.n_cross,
+                self.off_cross, self.off_results, self.off_groups,
+                self.off_strings, self.n_strings) = \
+                HEADER.unpack_from(self.m, 0)
+        if version != VERSION:
+            raise ValueError('%s: unknown version %d' % (fname, version))
+        self.off_data = self.off_strings + 4 * (self.n_strings + 1)
+
+    def close(self):
+        self.m.close()
+        self.f.close()
+
+    def string(self, idx):
+        if idx == NONE:
+            return None
+        (lo, hi) = OFFSET.unpack_from(self.m, self.off_strings + 4 * idx)
+        return self.m[self.off_data + lo : self.off_data + hi].decode('utf-8')
+
+    @property
+    def race(self):
+        return self.string(self.race_idx)
+
+    @property
+    def date(self):
+        return self.string(self.date_idx)
+
+    def group(self, n):
+        (name, sprints, first, count) = GROUP.unpack_from(self.m,
+                self.off_groups + n * GROUP.size)
+        return group(self.string(name), self.string(sprints), first, count)
+
+    def result(self, n):
+        v = list(RESULT.unpack_from(self.m,
+                self.off_results + n * RESULT.size))
+        for idx in RESULT_STR:
+            v[idx] = self.string(v[idx])
+        for idx, sentinel in RESULT_NULL.iteritems():
+            if v[idx] == sentinel:
+                v[idx] = None
+        v[7] = True if v[7] else False
+        return result(*v)
+
+    def crossings(self, rec):
+        L = []
+        off = self.off_cross + rec.cross_first * CROSS.size
+        for n in xrange(rec.cross_count):
+            v = list(CROSS.unpack_from(self.m, off))
+            for idx, sentinel in CROSS_NULL.iteritems():
+                if v[idx] == sentinel:
+                    v[idx] = None
+            v[7] = True if v[7] else False
+            L.append(cross(*v))
+            off = off + CROSS.size
+        return L
+
+    # group n's results, as records.
+    def results(self, n):
+        g = self.group(n)
+        return [ self.result(idx)
+                for idx in xrange(g.first, g.first + g.count) ]
+
+    def entry(self, n):
+        r = self.result(n)
+        entry = {
+            'rider': {
+                'id': r.id, 'fname': r.fname, 'lname': r.lname,
+                'cat': r.cat, 'height': r.height, 'weight': r.weight,
+                'power': r.power, 'male': r.male },
+            'finish': {
+                'timepos': r.timepos, 'meters': r.meters, 'mwh': r.mwh,
+                'duration': r.duration, 'start_msec': r.start_msec,
+                'end_msec': r.end_msec, 'watts': r.watts,
+                'est_cat': r.est_cat, 'pos': r.pos, 'wkg': r.wkg,
+                'beg_hr': r.beg_hr, 'end_hr': r.end_hr,
+                'points': r.points } }
+        if r.flags & HAS_CROSS:
+            entry['cross'] = [ {
+                    'time_ms': c.time_ms, 'mwh': c.mwh, 'line': c.line,
+                    'duration': c.duration, 'meters': c.meters, 'hr': c.hr,
+                    'speed': c.speed, 'forward': c.forward }
+                    for c in self.crossings(r) ]
+        return entry
+
+    def tree(self):
+        G = []
+        for n in xrange(self.n_groups):
+            g = self.group(n)
+            G.append({ 'name': g.name, 'sprints': json.loads(g.sprints),
+                    'results': [ self.entry(idx)
+                    for idx in xrange(g.first, g.first + g.count) ] })
+        return { 'race': self.race, 'date': self.date, 'group': G }
+
+
+#
+# Path to the first difference between two JSON trees, or None.
+#
+def differ(a, b, path = ''):
+    if isinstance(a, dict) and isinstance(b, dict):
+        for k in sorted(set(a.keys() + b.keys())):
+            if (k not in a) or (k not in b):
+                return '%s/%s' % (path, k)
+            d = differ(a[k], b[k], '%s/%s' % (path, k))
+            if d:
+                return d
+        return None
+    if isinstance(a, list) and isinstance(b, list):
+        if len(a) != len(b):
+            return '%s: %d != %d entries' % (path, len(a), len(b))
+        for n, (x, y) in enumerate(zip(a, b)):
+            d = differ(x, y, '%s[%d]' % (path, n))
+            if d:
+                return d
+        return None
+    if (a != b) or (type(a) is bool) != (type(b) is bool):
+        return '%s: %r != %r' % (path, a, b)
+    return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Binary results reader')
+    parser.add_argument('--check', metavar='JSON',
+            help='Compare with the JSON output of the same race')
+    parser.add_argument('file', help='Binary results file')
+    args = parser.parse_args()
+
+    try:
+        f = reader(args.file)
+    except ValueError, e:
+        sys.exit(str(e))
+
+    if args.check:
+        d = differ(f.tree(), json.load(open(args.check)))
+        if d:
+            sys.exit('%s differs from %s at %s' % (args.file, args.check, d))
+        print '%s matches %s' % (args.file, args.check)
+        return
+
+    print '%s  %s: %d groups, %d results, %d crossings' % (f.date, f.race,
+            f.n_groups, f.n_results, f.n_cross)
+    for n in xrange(f.n_groups):
+        g = f.group(n)
+        print '%-10s %5d' % (g.name, g.count)
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except KeyboardInterrupt:
+        pass
+    except SystemExit, se:
+        print "ERROR:", se
@@ -1,14 +1,17 @@
 #!/usr/bin/env python
 import sys, argparse, getpass
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import sqlite3
 import os, time, stat
+import random
+import threading, Queue
+from multiprocessing.pool import ThreadPool
 import mkresults
 from collections import namedtuple
 
 global args
-global dbh
 
 def post_credentials(session, username, password):
     # Credentials POSTing and tokens retrieval
@@ -16,13 +19,12 @@ def post_credentials(session, username, password):
 
     try:
         response = session.post(
-            url="https://secure.zwift.com/auth/realms/zwift/tokens/access/codes",
+            url=args.auth + "/auth/realms/zwift/tokens/access/codes",
             headers={
                 "Accept": "*/*",
                 "Accept-Encoding": "gzip, deflate",
                 "Connection": "keep-alive",
                 "Content-Type": "application/x-www-form-urlencoded",
-                "Host": "secure.zwift.com",
                 "User-Agent": "Zwift/1.5 (iPhone; iOS 9.0.2; Scale/2.00)",
                 "Accept-Language": "en-US;q=1",
             },
@@ -49,49 +51,76 @@ def post_credentials(session, username, password):
     except requests.exceptions.RequestException, e:
         print('HTTP Request failed: %s' % e)
 
+#
+# Delay before retrying a throttled or failed request.
+#  Honours Retry-After when the server sends one, otherwise backs off
+#  exponentially, with some jitter so the workers don't retry in step.
+#
+def retry_delay(response, attempt):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        pass
+    delay = min(args.backoff * (2 ** attempt), 60)
+    return delay + random.uniform(0, delay / 2)
+
+
 def query_player_profile(session, access_token, player_id):
     # Query Player Profile
     # GET https://us-or-rly101.zwift.com/api/profiles/<player_id>
-    try:
-        response = session.get(
-            url="https://us-or-rly101.zwift.com/api/profiles/%s" % player_id,
-            headers={
-                "Accept-Encoding": "gzip, deflate",
-                "Accept": "application/json",
-                "Connection": "keep-alive",
-                "Host": "us-or-rly101.zwift.com",
-                "User-Agent": "Zwift/115 CFNetwork/758.0.2 Darwin/15.0.0",
-                "Authorization": "Bearer %s" % access_token,
-                "Accept-Language": "en-us",
-            },
-            verify = args.verifyCert,
-        )
+    #  Retries with backoff on 429 (rate limited) and 5xx responses.
+    for attempt in range(args.retries + 1):
+        try:
+            response = session.get(
+                url=args.api + "/api/profiles/%s" % player_id,
+                headers={
+                    "Accept-Encoding": "gzip, deflate",
+                    "Accept": "application/json",
+                    "Connection": "keep-alive",
+                    "User-Agent": "Zwift/115 CFNetwork/758.0.2 Darwin/15.0.0",
+                    "Authorization": "Bearer %s" % access_token,
+                    "Accept-Language": "en-us",
+                },
+                verify = args.verifyCert,
+            )
 
-        if args.verbose:
-            print('Response HTTP Status Code: {status_code}'.format(
-                status_code=response.status_code))
-            print('Response HTTP Response Body: {content}'.format(
-                content=response.content))
+            if args.verbose:
+                print('Response HTTP Status Code: {status_code}'.format(
+                    status_code=response.status_code))
+                print('Response HTTP Response Body: {content}'.format(
+                    content=response.content))
 
-        json_dict = json.loads(response.content)
-        
-        return json_dict
+            if (response.status_code == 429) or \
+                    (response.status_code >= 500):
+                if attempt < args.retries:
+                    time.sleep(retry_delay(response, attempt))
+                    continue
+                print('HTTP Request failed: %s for %s' %
+                        (response.status_code, player_id))
+                return None
 
-    except requests.exceptions.RequestException, e:
-        print('HTTP Request failed: %s' % e)
+            json_dict = json.loads(response.content)
+
+            return json_dict
+
+        except requests.exceptions.RequestException, e:
+            print('HTTP Request failed: %s' % e)
+            return None
+        except ValueError, e:
+            print('Bad profile for %s: %s' % (player_id, e))
+            return None
 
 def logout(session, refresh_token):
     # Logout
     # POST https://secure.zwift.com/auth/realms/zwift/tokens/logout
     try:
         response = session.post(
-            url="https://secure.zwift.com/auth/realms/zwift/tokens/logout",
+            url=args.auth + "/auth/realms/zwift/tokens/logout",
             headers={
                 "Accept": "*/*",
                 "Accept-Encoding": "gzip, deflate",
                 "Connection": "keep-alive",
                 "Content-Type": "application/x-www-form-urlencoded",
-                "Host": "secure.zwift.com",
                 "User-Agent": "Zwift/1.5 (iPhone; iOS 9.0.2; Scale/2.00)",
                 "Accept-Language": "en-US;q=1",
             },
@@ -113,9 +142,15 @@ def login(session, user, password):
     access_token, refresh_token, expired_in = post_credentials(session, user, password)
     return access_token, refresh_token
 
-def updateRider(session, access_token, user):
+#
+# Fetch a profile, and convert it into a rider table row.
+#  Returns None if the profile could not be fetched.
+#
+def fetchRider(session, access_token, user):
     # Query Player Profile
     json_dict = query_player_profile(session, access_token, user)
+    if json_dict is None:
+        return None
     if args.verbose:
         print ("\n")
         print (json_dict)
@@ -132,29 +167,151 @@ def updateRider(session, access_token, user):
     print ("id=%s wt=%s m=%s [%s] <%s %s>\n" %
         (json_dict["id"], json_dict["weight"], json_dict["male"],
          json_dict["powerSourceModel"], fname.encode('ascii', 'ignore'), lname.encode('ascii', 'ignore')))
+    return (json_dict["id"], fname, lname, json_dict["age"],
+            json_dict["weight"], json_dict["height"], male, power)
+
+
+RIDER_INSERT = "insert into rider " + \
+        "(rider_id, fname, lname, age, weight, height, male, zpower," + \
+        " fetched_at) " + \
+        "values (?,?,?,?,?,?,?,?,datetime('now'))"
+
+RIDER_UPSERT = RIDER_INSERT + \
+        " on conflict(rider_id) do update" + \
+        " set fname = excluded.fname, lname = excluded.lname," + \
+        " age = excluded.age, weight = excluded.weight," + \
+        " height = excluded.height, male = excluded.male," + \
+        " zpower = excluded.zpower, fetched_at = excluded.fetched_at"
+
+RIDER_UPDATE = "update rider " + \
+        "set fname = ?, lname = ?, age = ?, weight = ?, height = ?," + \
+        " male = ?, zpower = ?, fetched_at = datetime('now')" + \
+        " where rider_id = ?"
+
+#
+# Write a batch of rider rows, inserting new riders and updating
+# existing ones.  Other columns (cat) are left alone.
+#  sqlite before 3.24 has no upsert: update the existing rows, then
+#  insert the rest.
+#
+def writeRiders(dbh, rows):
+    if sqlite3.sqlite_version_info >= (3, 24, 0):
+        dbh.executemany(RIDER_UPSERT, rows)
+    else:
+        dbh.executemany(RIDER_UPDATE, [ v[1:] + v[:1] for v in rows ])
+        dbh.executemany(RIDER_INSERT.replace('insert', 'insert or ignore'),
+                rows)
+
+
+#
+# Single writer for rider_names.sql3.
+#  Fetch workers queue rider rows, this thread owns the database
+#  connection and writes and commits them `batch' rows at a time,
+#  so an interrupted run keeps what it fetched.  WAL mode lets
+#  mkresults read the database while it is being updated.
+#
+class rider_writer(threading.Thread):
+    def __init__(self, fname, batch):
+        threading.Thread.__init__(self)
+        self.fname      = fname
+        self.batch      = batch
+        self.queue      = Queue.Queue(maxsize = batch * 4)
+        self.count      = 0
+
+    def put(self, v):
+        self.queue.put(v)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        dbh = sqlite3.connect(self.fname)
+        dbh.execute('pragma journal_mode=wal')
+        rows = []
+        while True:
+            v = self.queue.get()
+            if v is not None:
+                rows.append(v)
+            if rows and ((v is None) or (len(rows) >= self.batch)):
+                writeRiders(dbh, rows)
+                dbh.commit()
+                self.count = self.count + len(rows)
+                rows = []
+            if v is None:
+                break
+        dbh.close()
+
+
+#
+# Riders in the list whose profile was fetched within the last
+# max_age hours.
+#  fetched_at used to be a date only, those rows count as fetched at
+#  midnight.
+#
+def fresh_riders(L, max_age):
+    fresh = set()
+    if not os.path.exists('rider_names.sql3'):
+        return fresh
+    dbh = sqlite3.connect('rider_names.sql3')
     c = dbh.cursor()
+    for n in xrange(0, len(L), mkresults.SQL_CHUNK):
+        chunk = L[n : n + mkresults.SQL_CHUNK]
+        for data in c.execute('select rider_id from rider' +
+                ' where fetched_at >= datetime(\'now\', ?)' +
+                ' and rider_id in (%s)' % ','.join('?' * len(chunk)),
+                ['-%f hours' % max_age] + chunk):
+            fresh.add(data[0])
+    dbh.close()
+    return fresh
+
+
+#
+# Session shared by all workers, with a keep-alive connection pool
+# large enough for every worker.
+#
+def make_session(workers):
+    session = requests.session()
+    adapter = HTTPAdapter(pool_connections = 2, pool_maxsize = workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+#
+# Fetch the listed riders with a bounded number of concurrent requests,
+# writing them through a single writer thread.
+#
+def updateRiders(session, access_token, L):
+    writer = rider_writer('rider_names.sql3', args.batch)
+    writer.start()
+    pool = ThreadPool(args.workers)
+    failed = 0
     try:
-        c.execute("insert into rider " +
-            "(rider_id, fname, lname, age, weight, height, male, zpower," +
-            " fetched_at) " +
-            "values (?,?,?,?,?,?,?,?,date('now'))",
-             (json_dict["id"], fname, lname, json_dict["age"],
-             json_dict["weight"], json_dict["height"], male, power))
-    except sqlite3.IntegrityError:
-        c.execute("update rider " +
-            "set fname = ?, lname = ?, age = ?, weight = ?, height = ?," +
-            " male = ?, zpower = ?, fetched_at = date('now')" +
-            " where rider_id = ?",
-             (fname, lname, json_dict["age"],
-             json_dict["weight"], json_dict["height"], male, power,
-             json_dict["id"]))
+        for v in pool.imap_unordered(
+                lambda id: fetchRider(session, access_token, id), L):
+            if v is None:
+                failed = failed + 1
+                continue
+            writer.put(v)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        # flushes the riders fetched so far, even when interrupted.
+        pool.join()
+        writer.close()
+    if args.verbose or failed:
+        print 'Updated %d riders, %d failed' % (writer.count, failed)
 
 
 def get_rider_list():
     mkresults.dbh = sqlite3.connect('race_database.sql3')
     conf = mkresults.config(args.config)
     mkresults.conf = conf
-    mkresults.args = namedtuple('Args', 'no_cat debug')(no_cat=False, debug=args.verbose)
+    mkresults.args = namedtuple('Args', 'no_cat debug shards')(no_cat=False,
+            debug=args.verbose, shards=1)
 
     startTime = conf.start_ms / 1000
     retrievalTime = startTime + conf.start_window_ms / 1000
@@ -164,13 +321,12 @@ def get_rider_list():
         time.sleep(sleepTime)
         sleepTime = retrievalTime - time.time()
     conf.load_chalklines()
-    R, all_pos = mkresults.get_riders(conf.start_ms - conf.lookback_ms,
+    R = mkresults.get_riders(conf.start_ms - conf.lookback_ms,
             conf.finish_ms)
     return [ r.id for r in R.values() if mkresults.filter_start(r) ]
 
 def main(argv):
     global args
-    global dbh
 
     access_token = None
     cookies = None
@@ -182,6 +338,20 @@ def main(argv):
             dest='verifyCert', default=True)
     parser.add_argument('-c', '--config', help='Use config file')
     parser.add_argument('-u', '--user', help='Zwift user name')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+            help='Number of concurrent profile requests')
+    parser.add_argument('--batch', type=int, default=100,
+            help='Write and commit rider updates BATCH riders at a time')
+    parser.add_argument('--retries', type=int, default=5,
+            help='Retries for rate limited (429) or 5xx responses')
+    parser.add_argument('--backoff', type=float, default=1.0,
+            help='Initial retry delay in seconds, doubled on each retry')
+    parser.add_argument('--max-age', type=float, metavar='HOURS',
+            help='Skip riders whose profile was fetched within HOURS')
+    parser.add_argument('--auth', default='https://secure.zwift.com',
+            help='Zwift authentication server URL')
+    parser.add_argument('--api', default='https://us-or-rly101.zwift.com',
+            help='Zwift profile server URL')
     parser.add_argument('idlist', metavar='rider_id', type=int, nargs='*',
             help='rider ids to fetch')
     args = parser.parse_args()
@@ -199,7 +369,7 @@ def main(argv):
         args.user = cred['user']
         password = cred['pass']
 
-    session = requests.session()
+    session = make_session(args.workers)
 
     # test the credentials - token will expire, so we'll log in again after sleeping
     access_token, refresh_token = login(session, args.user, password)
@@ -215,13 +385,20 @@ def main(argv):
     if args.verbose:
         print 'Selected %d riders' % len(L)
 
+    #
+    # skip riders fetched recently, e.g. for the previous race.
+    #
+    if args.max_age is not None:
+        fresh = fresh_riders(L, args.max_age)
+        L = [ id for id in L if id not in fresh ]
+        print 'Profile cache: %d hits, %d misses (max age %g hours)' % (
+                len(fresh), len(L), args.max_age)
+        if not L:
+            return
+
     access_token, refresh_token = login(session, args.user, password)
 
-    dbh = sqlite3.connect('rider_names.sql3')
-    for id in L:
-        updateRider(session, access_token, id)
-    dbh.commit()
-    dbh.close()
+    updateRiders(session, access_token, L)
 
     logout(session, refresh_token)
 
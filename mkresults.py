@@ -2,18 +2,67 @@
 import sys, argparse
 import json
 import sqlite3
+import binresults
 import os, time, stat
+import calendar
+import cProfile
+import cPickle
+import hashlib
 import re
+import multiprocessing
+from bisect import bisect_left, bisect_right
+from array import array
+from itertools import izip, groupby, chain
+from collections import OrderedDict
+from operator import itemgetter, attrgetter
+from types import GeneratorType
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import resource
+except ImportError:
+    resource = None
 
 RICHMOND_LAP = 16 * 1000                # 1 lap of richmond = 16.09km
 
-class rider():
+#
+# A rider in the position window.
+#  Most riders in a window never start, so the placeholder name and
+#  details are only filled in by __getattr__ when first read, for
+#  riders that rider_info() did not find.
+#
+class rider(object):
+    __slots__ = ('id', 'pos', 'finish', 'end_time', 'dq_time', 'dq_reason',
+            'distance', 'points', 'end', 'xing', 'grp', 'dnf', 'dq',
+            'place', 'timepos',
+            'has_info', 'fname', 'lname', 'cat', 'weight', 'height', 'age',
+            'male', '_power', 'power', 'name',
+            'mwh', 'meters', 'msec', 'watts', 'wkg', 'km', 'pace', 'ecat')
+    INFO = frozenset(('fname', 'lname', 'cat', 'weight', 'height', 'age',
+            'male', '_power', 'power', 'name'))
+
     def __init__(self, id):
         self.id         = id
-        self.pos        = []
-        self.set_info(('Rider', str(id), None, 0, 0, 0, None, None))
+        self.pos        = pos_list()
+        self.has_info   = False
+        self.reset()
+
+    def __getattr__(self, k):
+        if k not in rider.INFO:
+            raise AttributeError(k)
+        self.set_info(('Rider', str(self.id), None, 0, 0, 0, None, None),
+                False)
         self.has_info   = False
+        return getattr(self, k)
 
+    #
+    # Clear the result state, and reopen the position window onto all
+    # of the records read so far.
+    #
+    def reset(self):
+        self.pos        = pos_list(self.pos.cols)
         self.finish     = []
         self.end_time   = None
         self.dq_time    = None
@@ -22,16 +71,27 @@ class rider():
 
         self.points     = 0
         self.end        = None
+        self.xing       = None
 
-    # allow accessing self via r[key]
-    def __getitem__(self, k):
-        return getattr(self, k)
+    #
+    # Line crossing index for the current position window, rebuilt
+    # whenever the window has been trimmed since it was made, and
+    # extended when it has only grown.
+    #
+    def crossings(self):
+        if (self.xing is None) or not self.xing.extend(self.pos):
+            self.xing = crossing_index(self.pos)
+        return self.xing
 
     def __str__(self):
         return '%6d %-35.35s records: %d' % (
                 self.id, self.name, len(self.pos))
 
-    def set_info(self, v):
+    #
+    # detect is False for the placeholder info, which has no name
+    # to take a category from.
+    #
+    def set_info(self, v, detect = True):
         if not v:
             return
         self.fname      = v[0]
@@ -46,62 +106,12 @@ class rider():
         self.name       = (self.fname + ' ' + self.lname).encode('utf-8')
         self.has_info   = True
 
-        cat = None
         #
-        # Try autodetecting cat from name.
+        # Try autodetecting cat from name, if the database has none.
         #  Could filter riders by race tag also.
         #
-
-        # NAME (X)
-        #   match category in parenthesis at end of name.
-        m = re.match('.*[(](.)[)]$', self.lname)
-        cat = m.group(1).upper() if m else None
-
-        # NAME X
-        #    match single letter at end of name. 
-        if cat is None:
-            m = re.match('.*\s(.)$', self.lname)
-            cat = m.group(1).upper() if m else None
-
-        # NAME RACE-X
-        #   match single letter following dash at end of name. 
-        if cat is None:
-            m = re.match('.*[-](.)$', self.lname)
-            cat = m.group(1).upper() if m else None
-
-        # NAME (RACE X)
-        #   match single letter with trailing paren at end of name. 
-        if cat is None:
-            m = re.match('.*\s(.)[)]$', self.lname)
-            cat = m.group(1).upper() if m else None
-
-        # NAME RACE-X INFO
-        # NAME RACE-X) INFO
-        #   match single letter following dash in name.
-        if cat is None:
-            m = re.match('.*[-](.)[ )].*', self.lname)
-            cat = m.group(1).upper() if m else None
-
-        # NAME (X) INFO
-        #   match category in parenthesis in name.
-        if cat is None:
-            m = re.match('.*[(](.)[)].*', self.lname)
-            cat = m.group(1).upper() if m else None
-
-        # NAME RACE X) INFO
-        #   match single letter following space in name.
-        if cat is None:
-            m = re.match('.*\s(.)[)].*', self.lname)
-            cat = m.group(1).upper() if m else None
-
-        #
-        # Sanity check cat - force to known categories.
-        #
-        if cat is not None:
-            cat = cat if cat in 'ABCDW' else None
-        if ((self.cat is None) or (self.cat == 'X')) and \
-                ((cat is not None) and (cat != 'X')):
-            self.cat = cat
+        if detect and (self.cat == 'X'):
+            self.cat = conf.cat_detect.match(self.lname) or 'X'
 
         #
         # No Database or self-classification, report by start group.
@@ -151,20 +161,6 @@ class rider():
     def power_type(self):
         return [None, 'zpower', 'smart', 'meter'][self._power]
 
-    # distance ridden.
-    @property
-    def km(self):
-        return float(self.meters / 100) / 10
-
-    # returns pace in km/hr.
-    @property
-    def pace(self):
-        if self.msec:
-            v = (float(self.meters) / float(self.msec)) * 3600
-            return float(int(v * 100)) / 100
-        else:
-            return 0
-
     @property
     def date(self):
         return conf.date
@@ -198,39 +194,196 @@ class rider():
         return self.ride_id + '.' + str(self.id)
 
 
-def summarize_ride(r):
-    s = r.pos[0]
-    e = r.end
+#
+# Rider fields an output template (http, mysql) can use, by name.
+#
+RIDER_FIELDS = ( 'id', 'place', 'timepos', 'name', 'fname', 'lname', 'cat',
+        'ecat', 'age', 'male', 'sex', 'height', 'weight', 'height_cm',
+        'weight_kg', 'power', 'power_type', 'km', 'pace', 'meters', 'mwh',
+        'msec', 'watts', 'wkg', 'points', 'date', 'start_msec', 'finish_msec',
+        'ride_msec', 'start_hr', 'finish_hr', 'ride_id', 'ride_uuid' )
+FIELD = dict([ (k, attrgetter(k)) for k in RIDER_FIELDS ])
+
+# accessors for the 'value' of each field of template T.
+def field_getters(T):
+    try:
+        return [ FIELD[f['value']] for f in T['fields'] ]
+    except KeyError, e:
+        sys.exit('Unknown output field %s' % e)
+
+
+#
+# Rules for autodetecting the category from the rider's last name.
+#  Tried in order, the first rule which matches gives the category
+#  (group 1), which must then be one of CATS.
+#
+CATS = ( 'A', 'B', 'C', 'D', 'W' )
+
+CAT_RULES = [
+    # NAME (X)
+    #   match category in parenthesis at end of name.
+    '.*[(](.)[)]$',
+
+    # NAME X
+    #    match single letter at end of name.
+    '.*\s(.)$',
+
+    # NAME RACE-X
+    #   match single letter following dash at end of name.
+    '.*[-](.)$',
+
+    # NAME (RACE X)
+    #   match single letter with trailing paren at end of name.
+    '.*\s(.)[)]$',
+
+    # NAME RACE-X INFO
+    # NAME RACE-X) INFO
+    #   match single letter following dash in name.
+    '.*[-](.)[ )].*',
+
+    # NAME (X) INFO
+    #   match category in parenthesis in name.
+    '.*[(](.)[)].*',
+
+    # NAME RACE X) INFO
+    #   match single letter following space in name.
+    '.*\s(.)[)].*',
+]
+
+
+#
+# Precompiled category detection.
+#  Results are cached by name, as the same team tagged names show up
+#  in every event.
+#
+class cat_rules():
+    def __init__(self, rules):
+        self.rules      = []
+        self.cache      = {}
+        for rule in rules:
+            try:
+                m = re.compile(rule)
+            except re.error, e:
+                sys.exit('Unable to parse category rule "%s": %s' %
+                        (rule, e))
+            if m.groups < 1:
+                sys.exit('Category rule "%s" has no group' % rule)
+            self.rules.append(m)
+
+    def match(self, lname):
+        if lname in self.cache:
+            return self.cache[lname]
+        cat = None
+        for rule in self.rules:
+            m = rule.match(lname)
+            if m:
+                cat = (m.group(1) or '').upper()
+                break
+
+        #
+        # Sanity check cat - force to known categories.
+        #
+        if cat not in CATS:
+            cat = None
+        self.cache[lname] = cat
+        return cat
+
+
+#
+# Estimated category from W/kg: the first row whose W/kg the rider is
+#  over, or ECAT_REST.  Riders without a W/kg are 'X', women are 'W'.
+#
+ECAT_WKG = [ (4, 'A'), (3.2, 'B'), (2.5, 'C') ]
+ECAT_REST = 'D'
+
+# negated, so the limits ascend for bisect.
+ECAT_LIMITS = [ -wkg for (wkg, cat) in ECAT_WKG ]
+
+def est_cat(wkg, male):
+    if (wkg == 0):
+        return 'X'
+    if (not male):
+        return 'W'
+    idx = bisect_right(ECAT_LIMITS, -wkg)
+    return ECAT_WKG[idx][1] if idx < len(ECAT_WKG) else ECAT_REST
+
 
-    # for DNF, use last position seen.
-    if r.dnf:
-        e = r.pos[-1]
+#
+# watts, W/kg, km and pace for a batch of rides.  Zero msec or weight
+# gives 0 for the values that need them, as does summarize().
+#
+def summary_lists(mwh, meters, msec, weight):
+    watts = []
+    wkg = []
+    km = []
+    pace = []
+    for (e, m, t, w) in izip(mwh, meters, msec, weight):
+        v = ((float(e) * 3600) / t) if t else 0
+        watts.append(v)
+        wkg.append((float(int(((v * 1000) / w) * 100)) / 100) if w else 0)
+        km.append(float(m / 100) / 10)
+        pace.append((float(int(((float(m) / float(t)) * 3600) * 100)) / 100)
+                if t else 0)
+    return watts, wkg, km, pace
+
+
+def summary_numpy(mwh, meters, msec, weight):
+    mwh = numpy.array(mwh, dtype = float)
+    meters = numpy.array(meters, dtype = numpy.int64)
+    t = numpy.array(msec, dtype = float)
+    w = numpy.array(weight, dtype = float)
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        watts = numpy.where(t != 0, (mwh * 3600) / t, 0)
+        wkg = numpy.trunc(((watts * 1000) / w) * 100) / 100
+        km = numpy.floor_divide(meters, 100).astype(float) / 10
+        pace = numpy.trunc(((meters / t) * 3600) * 100) / 100
+    return watts.tolist(), wkg.tolist(), km.tolist(), pace.tolist()
 
-    r.mwh = e.mwh - s.mwh
-    r.meters = e.meters - s.meters
-    r.msec = e.time_ms - s.time_ms
-    watts = 0
-    if r.msec:
-        watts = (float(r.mwh) * 3600) / r.msec
-    r.wkg = 0
-    if r.weight:
-        wkg = (watts * 1000) / r.weight
-        r.wkg = float(int(wkg * 100)) / 100
-    r.watts = int(watts)
 
-    if (r.wkg == 0):        r.ecat = 'X'
-    elif (not r.male):      r.ecat = 'W'
-    elif (r.wkg > 4):       r.ecat = 'A'
-    elif (r.wkg > 3.2):     r.ecat = 'B'
-    elif (r.wkg > 2.5):     r.ecat = 'C'
-    else:                   r.ecat = 'D'
+#
+# Ride summary for the whole field at once, from the start record and
+#  the finish record (for a DNF, the last one seen) of each rider.
+#  Sets mwh, meters, msec, watts, wkg, ecat, km and pace on the riders,
+#  so output reads stored values.  Uses NumPy when it is installed.
+#
+def summarize(F):
+    if not F:
+        return
+    C = [ r.pos.cols for r in F ]
+    S = [ r.pos.lo for r in F ]
+    E = [ (r.pos.hi - 1) if r.dnf else r.end.idx for r in F ]
+    mwh = [ col_value(c.mwh[e] - c.mwh[s]) for (c, s, e) in izip(C, S, E) ]
+    meters = [ col_value(c.meters[e] - c.meters[s])
+            for (c, s, e) in izip(C, S, E) ]
+    msec = [ col_value(c.time_ms[e] - c.time_ms[s])
+            for (c, s, e) in izip(C, S, E) ]
+    weight = [ r.weight or 0 for r in F ]
+
+    if numpy is not None:
+        (watts, wkg, km, pace) = summary_numpy(mwh, meters, msec, weight)
+    else:
+        (watts, wkg, km, pace) = summary_lists(mwh, meters, msec, weight)
+
+    for n, r in enumerate(F):
+        r.mwh = mwh[n]
+        r.meters = meters[n]
+        r.msec = msec[n]
+        r.watts = int(watts[n])
+        r.wkg = wkg[n] if weight[n] else 0
+        r.km = km[n]
+        r.pace = pace[n] if msec[n] else 0
+        r.ecat = est_cat(r.wkg, r.male)
 
 
 #
 # Observed position record, keyed by observation time.
+#  idx is the row of the record in the rider's pos_columns.
 #
-class pos():
-    def __init__(self, v):
+class pos(object):
+    __slots__ = ('time_ms', 'line_id', 'forward', 'meters', 'mwh',
+            'duration', 'elevation', 'speed', 'hr', 'idx')
+
+    def __init__(self, v, idx = None):
         self.time_ms    = v[0]
         self.line_id    = v[1]
         self.forward    = v[2]
@@ -240,6 +393,7 @@ class pos():
         self.elevation  = v[6]
         self.speed      = float((v[7] or 0) / 1000)     # meters/hour
         self.hr         = v[8]
+        self.idx        = idx
 
     def __str__(self):
         return ("time: %d  %s  line: %d %s  metres: %d" %
@@ -254,27 +408,417 @@ class pos():
             'forward': True if self.forward else False }
 
 
+NULL = float('nan')
+NULL_INT = -1                           # in the integer columns
+
+#
+# Convert a column value back to the value the database returned.
+#
+def col_value(x):
+    if type(x) is not float:
+        return None if x == NULL_INT else x
+    if x != x:
+        return None
+    i = int(x)
+    return i if i == x else x
+
+
+#
+# Columnar store of the position records for one rider.
+#  One array per field instead of one pos instance per record.
+#  time_ms does not fit in a 32 bit long, so the numeric fields are
+#  kept as doubles, with NaN standing in for NULL.  line_id and forward
+#  are integer arrays, which cannot hold NaN, and use NULL_INT.
+#
+class pos_columns():
+    def __init__(self):
+        self.time_ms    = array('d')
+        self.line_id    = array('i')
+        self.forward    = array('b')
+        self.meters     = array('d')
+        self.mwh        = array('d')
+        self.duration   = array('d')
+        self.elevation  = array('d')
+        self.speed      = array('d')
+        self.hr         = array('d')
+        self.cols       = (self.time_ms, self.line_id, self.forward,
+                self.meters, self.mwh, self.duration, self.elevation,
+                self.speed, self.hr)
+        self.nulls      = [ NULL if col.typecode == 'd' else NULL_INT
+                for col in self.cols ]
+
+    def __len__(self):
+        return len(self.time_ms)
+
+    def append(self, v):
+        self.extend([ (x,) for x in v ])
+
+    #
+    # Append a batch of records, given as one sequence per field.
+    #
+    def extend(self, v):
+        for col, null, x in izip(self.cols, self.nulls, v):
+            if None in x:
+                x = [ null if y is None else y for y in x ]
+            col.extend(x)
+
+    #
+    # The columns as machine bytes, and appending those: for passing
+    # records between processes, arrays pickle as lists of numbers.
+    #
+    def tostrings(self):
+        return [ col.tostring() for col in self.cols ]
+
+    def fromstrings(self, v):
+        for col, x in izip(self.cols, v):
+            col.fromstring(x)
+
+    def row(self, idx):
+        return [ col_value(col[idx]) for col in self.cols ]
+
+    # copy of the given rows, either a slice or a list of row numbers.
+    def take(self, rows):
+        c = pos_columns()
+        if isinstance(rows, slice):
+            c.extend([ col[rows] for col in self.cols ])
+        else:
+            c.extend([ [ col[idx] for idx in rows ] for col in self.cols ])
+        return c
+
+
+#
+# A window [lo, hi) onto a rider's position columns.
+#  Stands in for the old list of pos records: indexing builds a pos
+#  record on demand, slicing returns another window onto the same
+#  columns, and trimming either end only moves the window.
+#  The scanning stages read the columns directly via cols/lo/hi.
+#
+class pos_list():
+    def __init__(self, cols = None, lo = 0, hi = None):
+        self.cols       = cols if cols is not None else pos_columns()
+        self.lo         = lo
+        self.hi         = len(self.cols) if hi is None else hi
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def append(self, v):
+        self.cols.append(v)
+        self.hi = self.hi + 1
+
+    def extend(self, v):
+        self.cols.extend(v)
+        self.hi = self.hi + len(v[0])
+
+    # record at absolute row idx of the columns.
+    def at(self, idx):
+        return pos(self.cols.row(idx), idx)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            (start, stop, step) = k.indices(len(self))
+            if step != 1:
+                return [ self.at(self.lo + i)
+                        for i in xrange(start, stop, step) ]
+            return pos_list(self.cols, self.lo + start,
+                    self.lo + max(start, stop))
+        if k < 0:
+            k = k + len(self)
+        if (k < 0) or (k >= len(self)):
+            raise IndexError('pos index out of range')
+        return self.at(self.lo + k)
+
+    def __iter__(self):
+        for idx in xrange(self.lo, self.hi):
+            yield self.at(idx)
+
+    def __delitem__(self, k):
+        (start, stop, step) = k.indices(len(self))
+        if start == 0:
+            self.lo = self.lo + max(start, stop)
+        elif stop == len(self):
+            self.hi = self.lo + start
+        else:
+            raise ValueError('pos_list can only be trimmed at the ends')
+
+    def index(self, p):
+        if (p.idx is None) or (p.idx < self.lo) or (p.idx >= self.hi):
+            raise ValueError('pos is not in list')
+        return p.idx - self.lo
+
+    #
+    # Move the window (or only the listed rows of it) into new columns,
+    # releasing the records outside of it.  The pos records in refs
+    # are renumbered to match.
+    #
+    def compact(self, rows = None, refs = ()):
+        if rows is None:
+            rows = xrange(self.lo, self.hi)
+            self.cols = self.cols.take(slice(self.lo, self.hi))
+        else:
+            self.cols = self.cols.take(rows)
+        if refs:
+            remap = dict([ (idx, n) for n, idx in enumerate(rows) ])
+            for p in refs:
+                p.idx = remap.get(p.idx)
+        self.lo = 0
+        self.hi = len(self.cols)
+
+
+#
+# Line crossings within a pos_list window.
+#  For each line_id, built on first use: the rows crossing that line,
+#  and the furthest the rider had ridden (meters) at each of them.
+#  That reach never decreases, so finding the first crossing a given
+#  distance into the ride is a binary search instead of a scan.
+#  A window which has only grown at the end (--live) is added to the
+#  lines already built, instead of starting over.
+#
+class crossing_index():
+    def __init__(self, p):
+        self.cols       = p.cols
+        self.lo         = p.lo
+        self.hi         = p.hi
+        self.lines      = {}
+
+    #
+    # Take in the rows the window p has gained at its end.  False if
+    # p is not this window grown, and needs an index of its own.
+    #
+    def extend(self, p):
+        if (p.cols is not self.cols) or (p.lo != self.lo) or \
+                (p.hi < self.hi):
+            return False
+        for line_id, v in self.lines.iteritems():
+            self.add(line_id, v, self.hi, p.hi)
+        self.hi = p.hi
+        return True
+
+    def line(self, line_id):
+        v = self.lines.get(line_id)
+        if v is None:
+            v = self.lines[line_id] = (array('i'), array('d'))
+            self.add(line_id, v, self.lo, self.hi)
+        return v
+
+    # append the rows in [lo, hi) crossing line_id to its entry v.
+    def add(self, line_id, v, lo, hi):
+        (rows, reach) = v
+        c = self.cols
+        L = c.line_id
+        first = len(rows)
+        rows.extend([ idx for idx in xrange(lo, hi) if L[idx] == line_id ])
+        m = reach[-1] if reach else float('-inf')
+        for idx in rows[first:]:
+            if c.meters[idx] > m:               # NaN (NULL) never is
+                m = c.meters[idx]
+            reach.append(m)
+
+    #
+    # First row after the start of the window crossing line_id, at
+    # least distance meters after the start.  None if there is none.
+    #
+    def past(self, line_id, distance):
+        (rows, reach) = self.line(line_id)
+        m = self.cols.meters[self.lo]
+        lo = bisect_right(rows, self.lo)
+        hi = len(rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if (reach[mid] - m) < distance:
+                lo = mid + 1
+            else:
+                hi = mid
+        return rows[lo] if lo < len(rows) else None
+
+
+FETCH_ROWS = 8192
+
+POS_FIELDS = 'rider_id, time_ms, line_id, forward, meters, mwh,' + \
+        ' duration, elevation, speed, hr'
+
+# all records in a time window, in time order.
+POS_WINDOW_SQL = 'select ' + POS_FIELDS + ' from pos' + \
+        ' where time_ms between ? and ? order by time_ms asc'
+
+# all records in a time window, grouped by rider.
+POS_RIDER_SQL = 'select ' + POS_FIELDS + ' from pos' + \
+        ' where time_ms between ? and ? order by rider_id asc, time_ms asc'
+
+LINE_SQL = 'select line_id from chalkline where name = ?'
+
 #
 # Get all position events within the specified timeframe.
 #  Returns a list of riders, containing their position records.
 #
+#  Rows are fetched in batches, grouped by rider and then appended
+#  to the rider's columns one field at a time.  Riders are added in
+#  the order they first appear, so that the sharded reader gives the
+#  same dict.
+#
 def get_riders(begin_ms, end_ms):
+    if (args.shards > 1):
+        R = shard_riders(begin_ms, end_ms)
+        if R is not None:
+            return R
+
     R = {}
-    all_pos = []
     c = dbh.cursor()
-    for data in c.execute('select rider_id, time_ms, line_id, forward,' +
-            ' meters, mwh, duration, elevation, speed, hr from pos' +
-            ' where time_ms between ? and ? order by time_ms asc',
-            (begin_ms, end_ms)):
-        id = data[0]
-        if not id in R:
-            R[id] = rider(id)
-        position = pos(data[1:])
-        R[id].pos.append(position)
+    c.execute(POS_WINDOW_SQL, (begin_ms, end_ms))
+    for (id, cols) in read_window(c):
+        r = R.get(id)
+        if r is None:
+            r = R[id] = rider(id)
+        r.pos.extend(cols)
+    return R
+
+
+#
+# Records from an executed POS_WINDOW_SQL cursor, as (rider id,
+# columns) a batch at a time.
+#
+def read_window(c):
+    while True:
+        rows = c.fetchmany(FETCH_ROWS)
+        if not rows:
+            break
+        B = {}
+        I = []
+        for data in rows:
+            b = B.get(data[0])
+            if b is None:
+                b = B[data[0]] = []
+                I.append(data[0])
+            b.append(data)
+        for id in I:
+            yield id, zip(*B[id])[1:]
         if (args.debug):
-            print id, R[id].pos[-1]
-        all_pos.append((position, R[id]))
-    return R, all_pos
+            for data in rows:
+                print data[0], pos(data[1:])
+
+
+#
+# Parallel window reads, for --shards.
+#  The window is split into time ranges which are read by separate
+#  processes, each on its own read-only connection.  Every shard
+#  comes back as column bytes per rider, and is appended in time
+#  order.
+#  Returns None when the window is too small to be worth splitting.
+#
+SHARD_MIN_ROWS  = 100000                # rows per shard, at least
+
+POS_COUNT_SQL = 'select count(*) from pos where time_ms between ? and ?'
+
+def read_shard(span):
+    db = sqlite3.connect('file:%s?mode=ro' % args.database)
+    c = db.cursor()
+    c.execute(POS_WINDOW_SQL, span)
+    R = {}
+    I = []
+    for (id, cols) in read_window(c):
+        p = R.get(id)
+        if p is None:
+            p = R[id] = pos_columns()
+            I.append(id)
+        p.extend(cols)
+    db.close()
+    return [ (id, R[id].tostrings()) for id in I ]
+
+
+def shard_riders(begin_ms, end_ms):
+    c = dbh.cursor()
+    (rows,) = c.execute(POS_COUNT_SQL, (begin_ms, end_ms)).fetchone()
+    n = min(args.shards, rows / SHARD_MIN_ROWS)
+    if n < 2:
+        return None
+
+    #
+    # shards are appended as they arrive, in order, so only one is
+    # held in its transfer form at a time.
+    #
+    T = [ begin_ms + ((end_ms + 1 - begin_ms) * k) / n for k in range(n + 1) ]
+    R = {}
+    pool = multiprocessing.Pool(n)
+    try:
+        for S in pool.imap(read_shard,
+                [ (T[k], T[k + 1] - 1) for k in range(n) ]):
+            for (id, cols) in S:
+                r = R.get(id)
+                if r is None:
+                    r = R[id] = rider(id)
+                r.pos.cols.fromstrings(cols)
+                r.pos.hi = len(r.pos.cols)
+            S = None
+    finally:
+        pool.close()
+        pool.join()
+    return R
+
+
+#
+# Riders of a single race, from riders read for a wider timeframe.
+#  Each rider gets a new rider instance, with its pos window set to
+#  the records between begin_ms and end_ms of the shared columns, so
+#  several races can be scored from one read of the database.
+#  Returns the same riders as get_riders(begin_ms, end_ms).
+#
+def window_riders(R, begin_ms, end_ms):
+    W = {}
+    for id, r in R.iteritems():
+        t = r.pos.cols.time_ms
+        lo = bisect_left(t, begin_ms)
+        hi = bisect_right(t, end_ms)
+        if lo == hi:
+            continue
+        w = W[id] = rider(id)
+        w.pos = pos_list(r.pos.cols, lo, hi)
+    return W
+
+
+#
+# Walk the position events within the specified timeframe one rider
+# at a time, ordered by rider and then time.
+#  Yields each rider with their position records, so only a single
+#  ride needs to be in memory.
+#
+def iter_riders(begin_ms, end_ms):
+    r = None
+    c = dbh.cursor()
+    c.execute(POS_RIDER_SQL, (begin_ms, end_ms))
+    while True:
+        rows = c.fetchmany(FETCH_ROWS)
+        if not rows:
+            break
+        for id, run in groupby(rows, itemgetter(0)):
+            run = list(run)
+            if (r is not None) and (r.id != id):
+                yield r
+                r = None
+            if r is None:
+                r = rider(id)
+            r.pos.extend(zip(*run)[1:])
+            if (args.debug):
+                for data in run:
+                    print id, pos(data[1:])
+    if r is not None:
+        yield r
+
+
+#
+# Position events for a single rider within the timeframe.
+#
+def get_rider(id, begin_ms, end_ms):
+    c = dbh.cursor()
+    c.execute('select ' + POS_FIELDS + ' from pos' +
+            ' where rider_id = ? and time_ms between ? and ?' +
+            ' order by time_ms asc',
+            (id, begin_ms, end_ms))
+    rows = c.fetchall()
+    if not rows:
+        return None
+    r = rider(id)
+    r.pos.extend(zip(*rows)[1:])
+    return r
 
 
 #
@@ -282,19 +826,126 @@ def get_riders(begin_ms, end_ms):
 #
 def get_line(name):
     c = dbh.cursor()
-    c.execute('select line_id from chalkline where name = ?', (name,))
+    c.execute(LINE_SQL, (name,))
     data = c.fetchone()
     if not data:
         sys.exit('Could not find line { %s }' % name)
     return data[0]
 
 
-def rider_info(r):
+#
+# Covering indexes for the queries above: (name, table, columns).
+#  Each one lets the query run as a range seek over the index alone.
+#
+DB_INDEXES = [
+    ('pos_time_ms', 'pos', 'time_ms, rider_id, line_id, forward, meters,' +
+            ' mwh, duration, elevation, speed, hr'),
+    ('pos_rider_time_ms', 'pos', POS_FIELDS),
+    ('chalkline_name', 'chalkline', 'name, line_id'),
+]
+
+DB_SCHEMA = {
+    'pos': [ f.strip() for f in POS_FIELDS.split(',') ],
+    'chalkline': [ 'line_id', 'name' ],
+}
+
+
+def show_plan(c, sql, val):
+    print '  %s' % sql
+    for data in c.execute('explain query plan ' + sql, val):
+        print '    %s' % data[-1]
+
+
+def show_plans(c, begin_ms, end_ms):
+    show_plan(c, POS_WINDOW_SQL, (begin_ms, end_ms))
+    show_plan(c, POS_RIDER_SQL, (begin_ms, end_ms))
+    show_plan(c, LINE_SQL, ('',))
+
+
+#
+# Columns of the existing indexes on a table, keyed by index name.
+#
+def table_indexes(c, table):
+    I = {}
+    for data in c.execute('pragma index_list(%s)' % table).fetchall():
+        name = data[1]
+        cols = c.execute('pragma index_info(%s)' % name).fetchall()
+        I[name] = [ col[2] for col in sorted(cols) ]
+    return I
+
+
+#
+# Check the race database schema, and create the indexes needed by the
+# position queries if an equivalent index does not already exist.
+#  Needs write access to the database, so run it on a copy if the
+#  logger is still writing.  Opened mode=rw, so a mistyped name fails
+#  rather than creating an empty database.
+#
+def prepare_db(fname, begin_ms, end_ms):
+    try:
+        db = sqlite3.connect('file:%s?mode=rw' % fname)
+    except sqlite3.OperationalError, e:
+        sys.exit('%s: %s' % (fname, e))
+    c = db.cursor()
+
+    for table, fields in sorted(DB_SCHEMA.items()):
+        cols = [ data[1] for data in
+                c.execute('pragma table_info(%s)' % table) ]
+        if not cols:
+            sys.exit('%s: missing table %s' % (fname, table))
+        missing = [ f for f in fields if f not in cols ]
+        if missing:
+            sys.exit('%s: table %s missing columns %s' %
+                    (fname, table, ', '.join(missing)))
+
+    print 'Query plans before:'
+    show_plans(c, begin_ms, end_ms)
+
+    for name, table, cols in DB_INDEXES:
+        want = [ col.strip() for col in cols.split(',') ]
+        I = table_indexes(c, table)
+        have = [ n for n, v in I.items() if v[:len(want)] == want ]
+        if have:
+            print 'Index %s on %s(%s) exists' % (have[0], table, cols)
+            continue
+        print 'Creating index %s on %s(%s)' % (name, table, cols)
+        c.execute('create index %s on %s (%s)' % (name, table, cols))
+
+    print 'Analyzing'
+    c.execute('analyze')
+    db.commit()
+
+    print 'Query plans after:'
+    show_plans(c, begin_ms, end_ms)
+    db.close()
+
+
+# keep well under the sqlite limit of 999 host parameters.
+SQL_CHUNK = 500
+
+#
+# Pull names for a list of riders from the name database.
+#  Riders are looked up in chunks with "rider_id in (...)" rather than
+#  one query per rider.  Riders which are not found keep their
+#  placeholder info.
+#
+def rider_info(F):
+    t0 = time.time()
+    found = 0
+    R = dict([ (r.id, r) for r in F ])
+    ids = R.keys()
     c = name_dbh.cursor()
-    c.execute('select fname, lname, cat, weight, height,' +
-            ' age, male, zpower from rider' +
-            ' where rider_id = ?', (r.id,))
-    r.set_info(c.fetchone())
+    for n in xrange(0, len(ids), SQL_CHUNK):
+        chunk = ids[n : n + SQL_CHUNK]
+        for data in c.execute('select rider_id, fname, lname, cat,' +
+                ' weight, height, age, male, zpower from rider' +
+                ' where rider_id in (%s)' % ','.join('?' * len(chunk)),
+                chunk):
+            R[data[0]].set_info(data[1:])
+            found = found + 1
+    if (args.debug):
+        print 'Rider info: %d of %d riders found in %.3f sec' % (
+                found, len(R), time.time() - t0)
 
 
 #
@@ -316,7 +967,34 @@ MSEC_PER_HOUR   = (60 * 60 * 1000)
 MSEC_PER_MIN    = (60 * 1000)
 MSEC_PER_SEC    = (1000)
 
-class msec_time():
+#
+# Decorator: remember the results of f, by argument.  Holds up to
+# `size' entries, dropping the least recently used one when full.
+#
+def cached(size):
+    def wrap(f):
+        cache = OrderedDict()
+        def lookup(*key):
+            try:
+                v = cache.pop(key)
+            except KeyError:
+                if len(cache) >= size:
+                    cache.popitem(last = False)
+                v = f(*key)
+            cache[key] = v
+            return v
+        return lookup
+    return wrap
+
+
+#
+# Elapsed time split into fields.  Instances are shared through the
+# cache, so treat them as read-only.
+#
+@cached(1024)
+class msec_time(object):
+    __slots__ = ('hour', 'min', 'sec', 'msec')
+
     def __init__(self, msec):
         msec = ((msec + 99) / 100) * 100                    # roundup
         self.hour = msec / MSEC_PER_HOUR
@@ -470,11 +1148,10 @@ def show_results(F, tag):
     dbh.commit();
 
 
-def results(tag, F):
-    done = set()
-
-    t = msec_time(-time.timezone * 1000)
-    tzoff = 'UTC%+03d:%02d' % (t.hour, t.min)
+def results(tag, S):
+    off = clock.offset(conf.start_ms)
+    tzoff = 'UTC%s%02d:%02d' % ('-' if off < 0 else '+',
+            abs(off) / 60, abs(off) % 60)
     print '=' * 80
     print '=' * 10,
     print '%s   %s: %s' % (conf.date, conf.id, conf.name)
@@ -485,111 +1162,126 @@ def results(tag, F):
     print '    cutoff: %s  %s' % (hms(conf.finish_ms), tzoff)
     print '=' * 80
 
-    #
-    # create a sorted list of known rider categories
-    #
-    C = sorted(list(set([ r.cat for r in F ])))
-    for cat in C:
-        L = [ r for r in F if r.cat == cat ]
-        dnf = set([ r for r in L if filter_dnf(r) ])
-        dq = set([ r for r in L if filter_dq(r) ]).difference(dnf)
-        finish = set(L).difference(dq).difference(dnf)
-        show_results(list(finish), 'CAT ' + cat)
-        done = set(done).union(finish)
+    for cat in S.cats:
+        show_results(S.get(cat, 'finish'), 'CAT ' + cat)
 
     #
     # Lump all DQ/dnf together...
     #
-    dnf = set([ r for r in F if filter_dnf(r) ]).difference(done)
-    dq = set([ r for r in F if filter_dq(r) ]).difference(dnf)
+    dq = S.all('dq')
     if len(dq):
         finish = sorted(dq, key = lambda r: r.distance, reverse = True)
         finish = [ r for r in finish if r.distance > 0 ]
         show_nf('DQ, all', finish)
+    dnf = S.all('dnf')
     if len(dnf):
         finish = sorted(dnf, key = lambda r: r.distance, reverse = True)
         finish = [ r for r in finish if r.distance > 0 ]
         show_nf('DNF, all', finish)
 
-    if (True):
-        return
-
-    #
-    # repeat - show DQ and DNF at end.
-    #
-    for cat in C:
-        L = [ r for r in F if r.cat == cat ]
-        dnf = set([ r for r in L if filter_dnf(r) ])
-        dq = set([ r for r in L if filter_dq(r) ]).difference(dnf)
-        
-        dq = dq - done
-        dnf = dnf - done
-
-        if len(dq):
-            finish = sorted(dq, key = lambda r: r.distance)
-            finish = [ r for r in finish if r.distance > 0 ]
-            show_nf('DQ, CAT ' + cat, finish)
-        if len(dnf):
-            finish = sorted(dnf, key = lambda r: r.distance)
-            finish = [ r for r in finish if r.distance > 0 ]
-            show_nf('DNF, CAT ' + cat, finish)
-
 
+#
+# One result group.  The results, and each rider's crossings, are
+#  generators: they are produced as write_json() gets to them.
+#
 def json_cat(F, key, sprints=None):
-    cat_finish = []
-    for r in place(F):
-        s = r.pos[0]
-        e = r.end
-
-        finish = {
-            'timepos': r.timepos, 'meters': r.meters,
-            'mwh': r.mwh, 'duration': e.duration - s.duration,
-            'start_msec': s.time_ms, 'end_msec': e.time_ms,
-            'watts': r.watts, 'est_cat': r.ecat, 'pos': r.place,
-            'wkg': r.wkg,
-            'beg_hr': s.hr, 'end_hr': e.hr, 'points': r.points }
-        entry = { 'rider': r.data(), 'finish': finish }
-        cat_finish.append(entry)
-
-        if not args.split:
-            continue
-
-        cross = []
+    def cross(r):
         end = r.pos.index(r.end)
         for p in r.pos[0 : end + 1]:
-            cross.append(p.data())
-        entry['cross'] = cross
+            yield p.data()
+
+    def cat_finish():
+        for r in place(F):
+            s = r.pos[0]
+            e = r.end
+
+            finish = {
+                'timepos': r.timepos, 'meters': r.meters,
+                'mwh': r.mwh, 'duration': e.duration - s.duration,
+                'start_msec': s.time_ms, 'end_msec': e.time_ms,
+                'watts': r.watts, 'est_cat': r.ecat, 'pos': r.place,
+                'wkg': r.wkg,
+                'beg_hr': s.hr, 'end_hr': e.hr, 'points': r.points }
+            entry = { 'rider': r.data(), 'finish': finish }
+            if args.split:
+                entry['cross'] = cross(r)
+            yield entry
 
     sprint_data = []
     if sprints:
         for i, s in enumerate(sprints):
-            sprint = {'name': 'sprint %s' % (i + 1),
+            p = s.line
+            sprint_data.append({ 'name': 'sprint %s' % (i + 1),
+                    'line': p.line if p else conf.finish_line,
+                    'distance': int(round(p.distance)) if p else None,
                     'results': [ { 'points': e[0], 'rider_id': e[1].id,
-                    'fname': e[1].fname, 'lname': e[1].lname }
-                    for e in s ] }
-            sprint_data.append(sprint)
-
-    # distance, start_time
-
-    return { 'name': key, 'results': cat_finish, 'sprints': sprint_data }
-
-
-def dump_json(race_name, start_ms, F, sprints):
-    result = []
-    C = sorted(list(set([ r.cat for r in F ])))
-    dq = set([ r for r in F if filter_dq(r) ])
-    for cat in C:
-        L = [ r for r in F if r.cat == cat ]
-        dq = set([ r for r in L if filter_dq(r) ])
-        dnf = set([ r for r in L if filter_dnf(r) ])
-        finish = set(L).difference(dq).difference(dnf)
-        finish = sorted(finish, key = lambda r: r.end_time)
-        result.append(json_cat(finish, cat))
+                    'fname': e[1].fname, 'lname': e[1].lname,
+                    'gap_ms': e[2] } for e in s.results ] })
+
+    return { 'name': key, 'results': cat_finish(), 'sprints': sprint_data }
+
+
+#
+# Incremental JSON encoder.
+#  Writes the same text as json.dumps(v), except that generators are
+#  written as lists a member at a time, and dicts holding generators
+#  one key at a time.  Nothing else of the tree needs to be built.
+#  Plain list members are encoded JSON_CHUNK at a time, which is much
+#  quicker than one json.dumps() call each.
+#
+JSON_CHUNK = 1024
+
+def json_lazy(v):
+    if isinstance(v, dict):
+        return GeneratorType in map(type, v.itervalues())
+    return isinstance(v, GeneratorType)
+
+
+def write_json(f, v):
+    if isinstance(v, GeneratorType):
+        f.write('[')
+        sep = ''
+        chunk = []
+        for x in v:
+            lazy = json_lazy(x)
+            if not lazy:
+                chunk.append(x)
+            if chunk and (lazy or (len(chunk) >= JSON_CHUNK)):
+                f.write(sep + json.dumps(chunk)[1:-1])
+                sep = ', '
+                chunk = []
+            if lazy:
+                f.write(sep)
+                write_json(f, x)
+                sep = ', '
+        if chunk:
+            f.write(sep + json.dumps(chunk)[1:-1])
+        f.write(']')
+    elif json_lazy(v):
+        f.write('{')
+        sep = ''
+        for k, x in v.iteritems():
+            f.write(sep + json.dumps(k) + ': ')
+            write_json(f, x)
+            sep = ', '
+        f.write('}')
+    else:
+        f.write(json.dumps(v))
+
+
+#
+# The result groups of the JSON output, in order, for each category
+# the finishers then DQ and DNF.  Shared by dump_json and dump_binary.
+#
+def json_groups(S, sprints):
+    for cat in S.cats:
+        finish = sorted(S.get(cat, 'finish'), key = lambda r: r.end_time)
         if sprints:
             cat_sprints = sprints.get(cat, None)
         else:
             cat_sprints = None
-        result.append(json_cat(finish, cat, cat_sprints))
+        yield json_cat(finish, cat, cat_sprints)
+        dq = S.get(cat, 'dq')
         if len(dq):
             finish = sorted(dq, key = lambda r: r.distance)
             finish = [ r for r in finish if r.distance > 0 ]
@@ -599,7 +1291,8 @@ def dump_json(race_name, start_ms, F, sprints):
                 r.end = r.pos[-1]
                 r.end_time = r.end.time_ms
             
-            result.append(json_cat(finish, 'DQ-' + cat))
+            yield json_cat(finish, 'DQ-' + cat)
+        dnf = S.get(cat, 'dnf')
         if len(dnf):
             finish = sorted(dnf, key = lambda r: r.distance)
             finish = [ r for r in finish if r.distance > 0 ]
@@ -609,30 +1302,117 @@ def dump_json(race_name, start_ms, F, sprints):
                 r.end = r.pos[-1]
                 r.end_time = r.end.time_ms
             
-            result.append(json_cat(finish, 'DNF-' + cat))
-    race = { 'race': race_name, 'date': conf.date, 'group' : result }
-    print json.dumps(race)
+            yield json_cat(finish, 'DNF-' + cat)
+
+
+def dump_json(race_name, start_ms, S, sprints):
+    f = sys.stdout
+    if (args.ndjson):
+        #
+        # One line for the race, then one per group, followed by one
+        # per result in that group.
+        #
+        f.write(json.dumps({ 'race': race_name, 'date': conf.date }) + '\n')
+        for g in json_groups(S, sprints):
+            f.write(json.dumps({ 'group': g['name'],
+                    'sprints': g['sprints'] }) + '\n')
+            for entry in g['results']:
+                entry['group'] = g['name']
+                write_json(f, entry)
+                f.write('\n')
+        return
+
+    race = { 'race': race_name, 'date': conf.date,
+            'group' : json_groups(S, sprints) }
+    write_json(f, race)
+    f.write('\n')
+
+
+#
+# The same groups as dump_json, in the binary format of binresults.py.
+#
+def dump_binary(fname, race_name, S, sprints):
+    w = binresults.writer(fname, race_name, conf.date)
+    for g in json_groups(S, sprints):
+        w.group(g)
+    w.close()
 
 
 def min2ms(x):
     return int(x * 60 * 1000)
 
 
+SEC_PER_DAY     = (24 * 60 * 60)
+
+#
+# Local time of day with integer arithmetic.
+#  The UTC offset is looked up once, together with the span of time
+#  over which it holds, and only looked up again for a timestamp
+#  outside that span.  A span ends a day either side, or at the DST
+#  change, which is found by bisection.  Assumes no two changes less
+#  than a day apart.
+#
+class local_clock():
+    def __init__(self):
+        self.lo         = 0
+        self.hi         = 0
+        self.off        = 0
+
+    def utc_offset(self, sec):
+        return calendar.timegm(time.localtime(sec)) - sec
+
+    # first second in (lo, hi] with an offset other than lo's.
+    def change(self, lo, hi):
+        off = self.utc_offset(lo)
+        while (hi - lo) > 1:
+            mid = (lo + hi) / 2
+            if self.utc_offset(mid) == off:
+                lo = mid
+            else:
+                hi = mid
+        return hi
+
+    def span(self, sec):
+        self.off = self.utc_offset(sec)
+        (self.lo, self.hi) = (sec - SEC_PER_DAY, sec + SEC_PER_DAY)
+        if self.utc_offset(self.lo) != self.off:
+            self.lo = self.change(self.lo, sec)
+        if self.utc_offset(self.hi) != self.off:
+            self.hi = self.change(sec, self.hi)
+
+    # timestamp msec -> local seconds since midnight
+    def seconds(self, msec):
+        sec = msec / 1000
+        if not (self.lo <= sec < self.hi):
+            self.span(sec)
+        return (sec + self.off) % SEC_PER_DAY
+
+    # UTC offset in minutes at timestamp msec
+    def offset(self, msec):
+        self.seconds(msec)
+        return self.off / 60
+
+clock = local_clock()
+
+HOURS   = [ '%02d:' % h for h in range(24) ]
+MIN_SEC = [ '%02d:%02d' % (s / 60, s % 60) for s in range(3600) ]
+FRAC    = [ '.%03d' % n for n in range(1000) ]
+
+
 # timestamp msec -> H:M:S
 def hms(msec):
-    t = time.localtime(msec / 1000)
-    return time.strftime('%H:%M:%S', t)
+    sec = clock.seconds(msec)
+    return HOURS[sec / 3600] + MIN_SEC[sec % 3600]
 
 
-# timestamp msec -> M:S
+# elapsed msec -> M:S, not a timestamp, so no local time offset.
 def min_sec(msec):
-    t = time.localtime(msec / 1000)
-    return time.strftime('%M:%S', t)
+    return MIN_SEC[(msec / 1000) % 3600]
 
 
 # timestamp msec -> H:M:S.frac
 def stamp(msec):
-    return hms(msec) + ('.%03d' % (msec % 1000))
+    return hms(msec) + FRAC[msec % 1000]
 
 
 # elapsed msec -> H:M:S.f
@@ -666,16 +1446,28 @@ def filter_tag(r, tag):
 #   (may be larger for longer, delaeyed neutrals.
 #
 def filter_start(r):
-    start = None
-    for idx, p in enumerate(r.pos):
+    c = r.pos.cols
+    window_ms = conf.start_ms + conf.start_window_ms
 
-        # Crossing is outside start window, stop searching.
-        if (p.time_ms > (conf.start_ms + conf.start_window_ms)):
+    #
+    # Records are in time order, so the start window is a range of rows.
+    #  Crossings before the window all replace each other: only the
+    #  last one before start_ms matters.
+    #
+    first = bisect_left(c.time_ms, conf.start_ms, r.pos.lo, r.pos.hi)
+    last = bisect_right(c.time_ms, window_ms, first, r.pos.hi)
+    start = None
+    for idx in xrange(first - 1, r.pos.lo - 1, -1):
+        if (c.line_id[idx] == conf.start_line_id) and \
+                (c.forward[idx] == conf.start_forward):
+            start = idx
             break
 
+    for idx in xrange(first, last):
+
         # Skip if this isn't the correct line crossing.
-        if (p.line_id != conf.start_line_id) or \
-                (p.forward != conf.start_forward):
+        if (c.line_id[idx] != conf.start_line_id) or \
+                (c.forward[idx] != conf.start_forward):
             continue
 
         # First crossing seen, take it.
@@ -683,41 +1475,36 @@ def filter_start(r):
             start = idx
             continue
 
-        # Subsequent crossing.
-        #   - before start window, take it.
-        if (p.time_ms < conf.start_ms):
-            start = idx
-            continue
-
         # Subsequent crossing.
         #   - less than 3000 meters later, take it.
-        if ((p.meters - r.pos[start].meters) < 3000):
+        if ((c.meters[idx] - c.meters[start]) < 3000):
             start = idx
             continue
 
     if start is None:
         return False
 
-    s = r.pos[start]
+    s = r.pos.at(start)
 
     # If there is a rider corral, and rider isn't a late starter,
     # then perform further checks.  (late starters can just fly through...)
     if conf.corral_line and \
             (s.time_ms < (conf.start_ms + (20 * MSEC_PER_SEC))):
         # Find last crossing of corral line, from start.
-        for p in r.pos[start::-1]:
-            if (p.line_id != conf.corral_line_id):
+        for idx in xrange(start, r.pos.lo - 1, -1):
+            if (c.line_id[idx] != conf.corral_line_id):
                 continue
 
             #
             # make sure average pace through the corral is low.
             #
+            p = r.pos.at(idx)
             pace = avg_pace(p, s)
             if (pace > 18):
                 r.set_dq(p.time_ms, 'Corral: %2d km/h' % (pace))
             break
 
-    del(r.pos[0:start])
+    del(r.pos[0:start - r.pos.lo])
     if (args.debug):
         print 'START', r.id, r.pos[0]
 
@@ -732,49 +1519,60 @@ def filter_start(r):
 # This should trim and flag any rides which do not match the course.
 #  distance and correct finish is validated later.
 #
-def trim_course(r):
-    forward = conf.start_forward
-    for idx, p in enumerate(r.pos[1:]):
-        if (p.line_id != conf.finish_line_id):
+# --live carries on from row first, with the direction expected of the
+#  next finish crossing.  Returns that direction.
+#
+def trim_course(r, first = None, forward = None):
+    c = r.pos.cols
+    if first is None:
+        first = r.pos.lo + 1
+        forward = conf.start_forward
+    for idx in xrange(first, r.pos.hi):
+        if (c.line_id[idx] != conf.finish_line_id):
             continue
         if conf.alternate is not None:
             forward = not forward
-        if (p.forward != forward):
+        if (c.forward[idx] != forward):
             # crossed finish line in wrong direction
-            # trim the ride.  idx starts at 0, so add one.
+            # trim the ride at this crossing.
+            p = r.pos.at(idx)
             if (args.debug):
                 print 'WRONG', r.id, '%s' % ('fwd' if forward else 'rev'), p
             r.set_dq(p.time_ms, "WRONG COURSE")
-            del(r.pos[idx + 1:])
+            del(r.pos[idx - r.pos.lo:])
             break
-    return True
+    return forward
 
 
 #
 # Trims position records and sets maximum distance.
+#  --live carries on from row first.
 #
-def trim_crash(r):
-    s = r.pos[0]
+def trim_crash(r, first = None):
+    c = r.pos.cols
+    s = r.pos.lo
     l = s
-    r.distance = 0
-    for idx, p in enumerate(r.pos[1:]):
-        d = p.meters - s.meters
-
-        if (p.meters < l.meters):
-            r.set_dq(p.time_ms, "----CRASHED---")
-            r.distance = max(r.distance, p.meters)
-            del(r.pos[idx + 1:])
+    if first is None:
+        first = s + 1
+        r.distance = 0
+    for idx in xrange(first, r.pos.hi):
+        d = c.meters[idx] - c.meters[s]
+
+        if (c.meters[idx] < c.meters[l]):
+            r.set_dq(col_value(c.time_ms[idx]), "----CRASHED---")
+            r.distance = max(r.distance, col_value(c.meters[idx]))
+            del(r.pos[idx - s:])
             break
 
-        r.distance = d                  # distance so far
+        r.distance = col_value(d)       # distance so far
 
-        if (p.mwh < l.mwh):
-            r.set_dq(p.time_ms, "----CRASHED---")
-            del(r.pos[idx + 1:])
+        if (c.mwh[idx] < c.mwh[l]):
+            r.set_dq(col_value(c.time_ms[idx]), "----CRASHED---")
+            del(r.pos[idx - s:])
             break
-        if (p.duration < l.duration):
-            r.set_dq(p.time_ms, "----CRASHED---")
-            del(r.pos[idx + 1:])
+        if (c.duration[idx] < c.duration[l]):
+            r.set_dq(col_value(c.time_ms[idx]), "----CRASHED---")
+            del(r.pos[idx - s:])
             break
     return True
 
@@ -784,7 +1582,11 @@ def trim_crash(r):
 # then results just pick the "ASSIGNED" class, or the best weighted one.
 #
 class grp_finish():
-    def __init__(self, r, grp):
+    #
+    # idx is the finish crossing when it is already known (--jobs),
+    # -1 to look for it.
+    #
+    def __init__(self, r, grp, idx = -1):
         self.grp        = grp
         self.pos        = None
         self.dq_time    = None
@@ -792,25 +1594,24 @@ class grp_finish():
 
         r.finish.append(self)
 
-        s = r.pos[0]
-        for idx, p in enumerate(r.pos[1:]):
-            if ((p.meters - s.meters) >= grp.distance) and \
-                    (p.line_id == conf.finish_line_id):
-                self.pos = p
-                break
+        if idx == -1:
+            idx = r.crossings().past(conf.finish_line_id, grp.distance)
+        if idx is not None:
+            self.pos = r.pos.at(idx)
 
         # if no end position, this is a DNF. (or crash)
         if self.pos is None:
             return
 
-        if (r.pos[0].time_ms > grp.start_ms):
+        start_ms = col_value(r.pos.cols.time_ms[r.pos.lo])
+        if (start_ms > grp.start_ms):
             return
 
         #
         # If jumped before grace period, set DQ (or apply penalty?)
         #
-        if (r.pos[0].time_ms < (grp.start_ms - conf.grace_ms)):
-            t = msec_time(conf.start_ms - r.pos[0].time_ms)
+        if (start_ms < (grp.start_ms - conf.grace_ms)):
+            t = msec_time(conf.start_ms - start_ms)
             r.set_dq(grp.start_ms, 'Early: -%2d:%02d' % (t.min, t.sec))
 
 
@@ -862,67 +1663,536 @@ def select_finish(r):
     else:
         r.dq = False
 
-    # create the ride summary data for this finish.
-    summarize_ride(r)
+    # the ride summary data is created for all riders by summarize().
 
 #
-# Calculate points for each rider by iterating through all the points
-# definitions
-# note: only call after select_finish has been called on all riders
+# Set the start time of each start group.
+#  R holds the riders seen in the window, used to find the group starter.
 #
-def calculate_points(all_pos, points, points_final):
-    points_defs = {}
-    cur_defs = {}
-    next_defs = {}
-    sprints = {}
-    sprint_positions = {}
-    end_positions = {}
-    current_sprints = {}
-    end_sprints = {}
-    for cat in ('A', 'B', 'C', 'D', 'W'):
-        points_defs[cat] = iter(sorted(points, key=lambda p: p.distance))
-        cur_defs[cat] = next(points_defs[cat], None)
-        next_defs[cat] = next(points_defs[cat], None)
-        sprints[cat] = []
-    for p in all_pos:
-        (position, r) = p
-        if r.cat not in ('A', 'B', 'C', 'D', 'W'):
+def set_grp_start(R):
+    for grp in conf.grp:
+        if (grp.lead is not None) and (grp.lead in R):
+            grp.starter = R[grp.lead]
+            grp.start_ms = grp.starter.pos[0].time_ms
+        elif grp.delay_ms is not None:
+            grp.start_ms = conf.start_ms + grp.delay_ms
+        else:
+            grp.start_ms = conf.start_ms
+
+
+#
+# Drop the position records that are no longer needed once the finish
+# records are created: keep the start, the last record and the finish
+# line crossings.  Only used when split times and points are not wanted.
+#
+def reduce_ride(r):
+    refs = [ f.pos for f in r.finish if f.pos is not None ]
+    rows = set([ r.pos.lo, r.pos.hi - 1 ] + [ p.idx for p in refs ])
+    r.pos.compact(sorted(rows), refs)
+
+
+#
+# Streaming version of the per-rider stages.
+#  Riders are read one at a time and go through filter_start,
+#  trim_course, trim_crash and grp_finish before the next one is loaded,
+#  so memory depends on the largest single ride rather than on the
+#  size of the event.  Returns the riders which started.
+#
+def stream_riders(begin_ms, end_ms):
+    #
+    # group starters are needed before any finish can be checked.
+    #
+    R = {}
+    for grp in conf.grp:
+        if (grp.lead is not None) and (grp.lead not in R):
+            r = get_rider(grp.lead, begin_ms, end_ms)
+            if r is not None:
+                filter_start(r)
+                R[r.id] = r
+    set_grp_start(R)
+
+    keep_all = args.split or conf.points
+    F = []
+    for r in iter_riders(begin_ms, end_ms):
+        if not filter_start(r):
+            continue
+        trim_course(r)
+        trim_crash(r)
+        r.pos.compact()
+        for grp in conf.grp:
+            grp_finish(r, grp)
+        if not keep_all:
+            reduce_ride(r)
+        F.append(r)
+
+    #
+    # use the streamed copy of a starter, it will pick up rider info.
+    #
+    S = dict([ (r.id, r) for r in F if r.id in R ])
+    for grp in conf.grp:
+        if grp.starter is not None:
+            grp.starter = S.get(grp.starter.id, grp.starter)
+    return F
+
+
+#
+# Parallel version of the per-rider stages, for --jobs.
+#  Riders are already read.  Worker processes, forked with the riders
+#  in pool_R, run filter_start, trim_course, trim_crash and grp_finish
+#  on a share of them, and send back what those stages leave: the
+#  position window, distance, DQ and each group's finish row.  That
+#  is then applied to the riders here, in the order of R, so that the
+#  results are the same as with --jobs 1.
+#  Returns the riders which started.
+#
+POOL_SHARES     = 4                     # pieces of work per process
+
+pool_R = None
+
+def pool_stage(ids):
+    S = []
+    for id in ids:
+        r = pool_R[id]
+        if not filter_start(r):
+            continue
+        trim_course(r)
+        trim_crash(r)
+        for grp in conf.grp:
+            grp_finish(r, grp)
+        S.append((id, r.pos.lo, r.pos.hi, r.distance, r.dq_time,
+                r.dq_reason, [ None if f.pos is None else f.pos.idx
+                for f in r.finish ]))
+    return S
+
+
+def pool_riders(R):
+    global pool_R
+
+    #
+    # group starters are needed before any finish can be checked.
+    #  Started on copies, R has to reach the workers untouched.
+    #
+    L = {}
+    for grp in conf.grp:
+        if (grp.lead in R) and (grp.lead not in L):
+            s = L[grp.lead] = rider(grp.lead)
+            s.pos = pos_list(R[grp.lead].pos.cols, R[grp.lead].pos.lo,
+                    R[grp.lead].pos.hi)
+            filter_start(s)
+    set_grp_start(L)
+
+    ids = R.keys()
+    size = len(ids) / (args.jobs * POOL_SHARES) + 1
+    pool_R = R
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        S = pool.map(pool_stage, [ ids[n : n + size]
+                for n in xrange(0, len(ids), size) ])
+    finally:
+        pool.close()
+        pool.join()
+        pool_R = None
+
+    F = []
+    for (id, lo, hi, distance, dq_time, dq_reason, ends) in chain(*S):
+        r = R[id]
+        r.pos = pos_list(r.pos.cols, lo, hi)
+        r.distance = distance
+        r.dq_time = dq_time
+        r.dq_reason = dq_reason
+        for grp, idx in izip(conf.grp, ends):
+            grp_finish(r, grp, idx)
+        F.append(r)
+    set_grp_start(R)
+    return F
+
+
+# records this recent may still be being written by the logger.
+LIVE_SETTLE_MS = 2 * MSEC_PER_SEC
+
+#
+# Live results, updated while the race is running.
+#  Tails the pos table past a high water mark on time_ms.  Each rider's
+#  live_rider keeps where the course and crash checks got to, so only
+#  the new records go through them.  The finish records are made again
+#  for the riders with new records, or for everyone when a group start
+#  time moves.
+#
+class live_race():
+    def __init__(self, begin_ms, end_ms):
+        self.R          = {}
+        self.S          = {}                # live_rider, by id
+        self.F          = {}                # riders which have started
+        self.hwm        = begin_ms - 1
+        self.end_ms     = end_ms
+        self.starts     = None
+
+    def done(self):
+        return self.hwm >= self.end_ms
+
+    #
+    # Read the records written since the last poll.
+    #  Returns the ids of the riders which have new records.
+    #
+    def poll(self):
+        c = dbh.cursor()
+        rows = c.execute(POS_WINDOW_SQL,
+                (self.hwm + 1, self.end_ms)).fetchall()
+        if not rows:
+            upper = self.hwm
+        else:
+            upper = rows[-1][1] - LIVE_SETTLE_MS
+        if (time.time() * 1000) > (self.end_ms + LIVE_SETTLE_MS):
+            upper = self.end_ms
+        B = {}
+        for data in rows:
+            if data[1] > upper:
+                break
+            B.setdefault(data[0], []).append(data)
+        for id, b in B.iteritems():
+            r = self.R.get(id)
+            if r is None:
+                r = self.R[id] = rider(id)
+            r.pos.cols.extend(zip(*b)[1:])
+        self.hwm = max(self.hwm, upper)
+        return set(B.keys())
+
+    def update(self, dirty):
+        #
+        # the start may still move until the start window has closed,
+        # those riders are started over.
+        #
+        final = self.hwm >= (conf.start_ms + conf.start_window_ms)
+        for id in dirty:
+            r = self.R[id]
+            s = self.S.get(id)
+            if (s is None) or not s.final:
+                s = self.S[id] = live_rider(r, final)
+            else:
+                s.advance(r)
+            if s.started:
+                self.F[id] = r
+            else:
+                self.F.pop(id, None)
+
+        #
+        # a new group start time changes everyone's finish records.
+        #
+        set_grp_start(self.R)
+        starts = [ grp.start_ms for grp in conf.grp ]
+        if starts != self.starts:
+            dirty = self.F.keys()
+            self.starts = starts
+
+        F = [ self.F[id] for id in dirty if id in self.F ]
+        for r in F:
+            self.S[r.id].finish(r)
+
+        # names may have been fetched since the last update.
+        rider_info([ r for r in self.F.values() if not r.has_info ])
+        for r in F:
+            select_finish(r)
+        summarize(F)
+
+    def riders(self):
+        F = self.F.values()
+        if conf.required_tag is not None:
+            F = [ r for r in F if filter_tag(r, conf.required_tag) ]
+        return F
+
+
+#
+# Where the live stages got to for one rider.
+#  Made by running the start, course and crash stages over everything
+#  read so far; advance() then runs only the records read since through
+#  the course and crash checks.  final when the start window had closed,
+#  so the start can no longer move.  dq is the DQ from those stages,
+#  the finish records add theirs on top of it.  laps and last_ms are
+#  for show_live().
+#
+class live_rider():
+    def __init__(self, r, final):
+        self.final      = final
+        r.reset()
+        self.started    = filter_start(r)
+        self.laps       = 0
+        if not self.started:
+            return
+        self.forward    = trim_course(r)
+        trim_crash(r)
+        self.stopped    = r.pos.hi < len(r.pos.cols)
+        self.count_laps(r, r.pos.lo + 1)
+        self.dq         = (r.dq_time, r.dq_reason)
+
+    def advance(self, r):
+        if (not self.started) or self.stopped:
+            return
+        (r.dq_time, r.dq_reason) = self.dq
+        first = r.pos.hi
+        r.pos.hi = len(r.pos.cols)
+        self.forward = trim_course(r, first, self.forward)
+        trim_crash(r, first)
+        self.stopped = r.pos.hi < len(r.pos.cols)
+        self.count_laps(r, first)
+        self.dq = (r.dq_time, r.dq_reason)
+
+    # finish line crossings in rows [first, end of the window), and
+    # the time of the last row.
+    def count_laps(self, r, first):
+        c = r.pos.cols
+        self.laps += len([ idx for idx in xrange(first, r.pos.hi)
+                if c.line_id[idx] == conf.finish_line_id ])
+        self.last_ms = col_value(c.time_ms[r.pos.hi - 1])
+
+    def finish(self, r):
+        (r.dq_time, r.dq_reason) = self.dq
+        r.finish = []
+        r.end = None
+        r.end_time = None
+        for grp in conf.grp:
+            grp_finish(r, grp)
+
+
+#
+# Provisional order: finishers by finish time, then riders still on
+# course by distance covered, then DQs.
+#
+def live_order(r, s):
+    if r.dq:
+        return (2, -r.meters, s.last_ms)
+    if not r.dnf:
+        return (0, r.end_time, 0)
+    return (1, -r.meters, s.last_ms)
+
+
+def show_live(F, now_ms, S):
+    print '\n== LIVE @ %s  %s: %s ' % (hms(now_ms), conf.id, conf.name) + \
+            '=' * 20
+    for cat in sorted(list(set([ r.cat for r in F ]))):
+        L = sorted([ r for r in F if r.cat == cat ],
+                key = lambda r: live_order(r, S[r.id]))
+        print '== CAT %s ' % cat + '=' * 40 + '  lap    km  last seen'
+        for n, r in enumerate(L):
+            s = S[r.id]
+            if r.dq:
+                status = r.dq_reason
+            elif not r.dnf:
+                status = 'FINISHED ' + hms(r.end_time)
+            else:
+                status = ''
+            print '%3d. %-40.40s  %3d  %5.1f  %s  %s' % (n + 1, r.name,
+                    s.laps, r.km, hms(s.last_ms), status)
+
+
+#
+# Follow the race until the window closes, rendering the standings
+# every `interval' seconds.  Returns the riders which started, ready
+# for select_finish and the normal output.
+#
+def live_results(begin_ms, end_ms, interval):
+    race = live_race(begin_ms, end_ms)
+    while True:
+        dirty = race.poll()
+        if dirty:
+            race.update(dirty)
+            show_live(race.riders(), race.hwm, race.S)
+        if race.done():
+            break
+        sys.stdout.flush()
+        time.sleep(interval)
+    return race.F.values()
+
+
+#
+# The POINTS lines of a race, compiled for calculate_points().
+#  defs holds each category's points lines in distance order, as
+#  indexes into points.  For POINTS_MODE line, lines holds for each
+#  (line_id, direction, category) the distances of the points lines on
+#  it in sorted order, with their index in points.  A points line is
+#  then open from its distance until the next one on the same line and
+#  direction, so any number of sprint and KOM lines can be open at
+#  once, and the one a crossing counts for is a single bisect away.
+#
+POINTS_CATS = ('A', 'B', 'C', 'D', 'W')
+POINTS_MODES = ('leader', 'line')
+
+class points_table(object):
+    def __init__(self, points):
+        self.order  = sorted(xrange(len(points)),
+                key=lambda n: points[n].distance)
+        self.defs   = dict([ (cat, [ n for n in self.order
+                if cat in points[n].cats ]) for cat in POINTS_CATS ])
+        self.lines  = dict([ (cat, {}) for cat in POINTS_CATS ])
+        for n in self.order:
+            p = points[n]
+            for cat in p.cats:
+                (D, N) = self.lines[cat].setdefault((p.line_id, p.forward),
+                        ([], []))
+                D.append(p.distance)
+                N.append(n)
+
+    #
+    # The points line a crossing at distance meters into the ride
+    # counts for, or None.
+    #
+    def window(self, D, N, distance):
+        k = bisect_right(D, distance)
+        return N[k - 1] if k else None
+
+
+#
+# One scored sprint: the points line (None for POINTS_FINAL), and the
+# (points, rider, gap_ms) of each placed rider in crossing order, where
+# gap_ms is the time behind the first rider across the line.
+#
+class sprint(object):
+    __slots__ = ('line', 'results')
+
+    def __init__(self, line, results):
+        self.line = line
+        self.results = results
+
+
+#
+# The sprint on line from its (time_ms, id, idx, rider) crossings E,
+# with the places awarded the given points.
+#
+def place_sprint(line, E, points):
+    E.sort()
+    first = E[0][0]
+    return sprint(line, [ (pts, r, int(time_ms - first))
+            for (pts, (time_ms, id, idx, r)) in izip(points, E) ])
+
+
+#
+# POINTS_MODE line: each rider's crossings of the points lines in the
+#  POINTS direction, before their finish, are looked up in the compiled
+#  table by the rider's own distance.  A rider places at most once in
+#  each sprint, and once at the finish.
+#
+def line_points(F, points, table, events, finals):
+    for r in F:
+        if (r.cat not in POINTS_CATS) or not r.end:
             continue
-        distance = position.meters - r.pos[0].meters
-        if distance >= cur_defs[r.cat].distance:
-            while next_defs[r.cat] and distance >= next_defs[r.cat].distance:
-                cur_defs[r.cat] = next_defs[r.cat]
-                next_defs[r.cat] = next(points_defs[r.cat], None)
-                sprint_positions[r.cat] = 0
-                if current_sprints.get(r.cat, None):
-                    sprints[r.cat].append(current_sprints[r.cat])
-                current_sprints[r.cat] = []
-            if r.end and (position.meters < r.end.meters) and \
-                    (position.line_id == cur_defs[r.cat].line_id):
-                place = sprint_positions.get(r.cat, 0) + 1
-                sprint_positions[r.cat] = place
-                if place <= len(cur_defs[r.cat].points):
-                    points = cur_defs[r.cat].points[place - 1]
-                    r.points += points
-                    if r.cat in current_sprints:
-                        current_sprints[r.cat].append((points, r))
-                    else:
-                        current_sprints[r.cat] = [(points, r)]
-            if r.end and position.meters == r.end.meters:
-                place = end_positions.get(r.cat, 0) + 1
-                end_positions[r.cat] = place
-                if place <= len(points_final):
-                    points = points_final[place - 1]
-                    r.points += points
-                    if r.cat in end_sprints:
-                        end_sprints[r.cat].append((points, r))
-                    else:
-                        end_sprints[r.cat] = [(points, r)]
-    for cat in ('A', 'B', 'C', 'D', 'W'):
-        if current_sprints.get(cat, None):
-            sprints[cat].append(current_sprints[cat])
-        if end_sprints.get(cat, None):
-            sprints[cat].append(end_sprints[cat])
+        c = r.pos.cols
+        start = c.meters[r.pos.lo]
+        end = r.end.meters
+        X = r.crossings()
+        placed = set()
+        for (line_id, forward), (D, N) in table.lines[r.cat].iteritems():
+            for idx in X.line(line_id)[0]:
+                meters = c.meters[idx]
+                if not (meters < end) or (c.forward[idx] != forward):
+                    continue
+                n = table.window(D, N, meters - start)
+                if (n is None) or (n in placed):
+                    continue
+                placed.add(n)
+                events.setdefault((n, r.cat), []).append(
+                        (c.time_ms[idx], r.id, idx, r))
+        finals[r.cat].append((r.end.time_ms, r.id, r.end.idx, r))
+
+
+#
+# POINTS_MODE leader: a category's points lines open one after the
+#  other, each when the first rider of the category to get there
+#  reaches its distance, and stay open until the next one opens.
+#  Every crossing of the open line before the rider's finish, in
+#  either direction, takes a place once the rider has ridden the
+#  line's distance.  So does every record at the rider's finish
+#  distance, for POINTS_FINAL.
+#  This is the scoring of a single points pointer walked over the
+#  records of the whole category in time order, without the walk: the
+#  record (time_ms, id, idx) at which each line opens is found first,
+#  then each crossing is placed by a bisect over them.
+#
+def leader_points(F, points, table, events, finals):
+    for cat in POINTS_CATS:
+        defs = table.defs[cat]
+        R = [ r for r in F if r.cat == cat ]
+        if not defs or not R:
+            continue
+        D = [ points[n].distance for n in defs ]
+        opens = [ None ] * len(D)
+        for r in R:
+            c = r.pos.cols
+            start = c.meters[r.pos.lo]
+            k = 1
+            for idx in xrange(r.pos.lo, r.pos.hi):
+                if k == len(D):
+                    break
+                distance = c.meters[idx] - start
+                while (k < len(D)) and (distance >= D[k]):
+                    key = (c.time_ms[idx], r.id, idx)
+                    if (opens[k] is None) or (key < opens[k]):
+                        opens[k] = key
+                    k += 1
+        # lines open in distance order, those never reached drop out.
+        opens = [ key for key in opens[1:] if key is not None ]
+
+        # the points line open at record key, if the rider has reached it.
+        def current(key, distance):
+            k = bisect_right(opens, key)
+            return k if distance >= D[k] else None
+
+        for r in R:
+            if not r.end:
+                continue
+            c = r.pos.cols
+            start = c.meters[r.pos.lo]
+            end = r.end.meters
+            X = r.crossings()
+            for line_id in set([ points[n].line_id for n in defs ]):
+                for idx in X.line(line_id)[0]:
+                    meters = c.meters[idx]
+                    if not (meters < end):
+                        continue
+                    key = (c.time_ms[idx], r.id, idx)
+                    k = current(key, meters - start)
+                    if (k is None) or (points[defs[k]].line_id != line_id):
+                        continue
+                    events.setdefault((defs[k], cat), []).append(key + (r,))
+            M = c.meters[r.pos.lo:r.pos.hi].tolist()
+            n = -1
+            while True:
+                try:
+                    n = M.index(end, n + 1)
+                except ValueError:
+                    break
+                idx = r.pos.lo + n
+                key = (c.time_ms[idx], r.id, idx)
+                if current(key, M[n] - start) is not None:
+                    finals[cat].append(key + (r,))
+
+
+#
+# Calculate points for each rider from the POINTS definitions, scored
+#  as POINTS_MODE has it (see leader_points and line_points).  The
+#  places go by crossing time once all riders are done.  Returns the
+#  sprints of each category, in distance order.
+# note: only call after select_finish has been called on all riders
+#
+def calculate_points(F, points, points_final, mode):
+    table = points_table(points)
+    events = {}
+    finals = dict([ (cat, []) for cat in POINTS_CATS ])
+    if mode == 'line':
+        line_points(F, points, table, events, finals)
+    else:
+        leader_points(F, points, table, events, finals)
+
+    sprints = {}
+    for cat in POINTS_CATS:
+        S = sprints[cat] = []
+        for n in table.order:
+            E = events.get((n, cat))
+            if E:
+                S.append(place_sprint(points[n], E, points[n].points))
+        if finals[cat] and points_final:
+            S.append(place_sprint(None, finals[cat], points_final))
+        for s in S:
+            for (pts, r, gap_ms) in s.results:
+                r.points += pts
     return sprints
 
 
@@ -938,6 +2208,39 @@ def filter_dnf(r):
     return r.dnf
 
 
+#
+# Riders bucketed by (cat, status) in a single pass, shared by the
+#  output functions.  status is 'finish', 'dq' or 'dnf', which are
+#  exclusive (see select_finish).  Riders keep their order in F.
+#
+class standings():
+    def __init__(self, F):
+        self.F          = F
+        self.groups     = {}
+        for r in F:
+            if filter_dnf(r):
+                status = 'dnf'
+            elif filter_dq(r):
+                status = 'dq'
+            else:
+                status = 'finish'
+            L = self.groups.get((r.cat, status))
+            if L is None:
+                L = self.groups[(r.cat, status)] = []
+            L.append(r)
+        self.cats = sorted(list(set([ cat for (cat, status) in self.groups ])))
+
+    def get(self, cat, status):
+        return self.groups.get((cat, status), [])
+
+    # riders with the given status, in category order.
+    def all(self, status):
+        L = []
+        for cat in self.cats:
+            L.extend(self.get(cat, status))
+        return L
+
+
 def strT_to_sec(val):
     m = re.match('(\d+):(\d+)', val)
     if m:
@@ -987,7 +2290,8 @@ class config_points(object):
         self.line = None
         self.distance = None
         m = re.match(
-            '([0-9:]+)\s+(fwd|rev)\s+\{\s*(.+?)\s*\}\s+(km|mi)\s+([0-9\.]+)',
+            '([0-9:]+)\s+(fwd|rev)\s+\{\s*(.+?)\s*\}\s+(km|mi)\s+([0-9\.]+)' +
+            '(?:\s+cat\s+(\S+))?',
             val)
         if not m:
             sys.exit('Unable to parse points info "%s"' % val)
@@ -998,10 +2302,16 @@ class config_points(object):
         self.line_id = None
         self.distance = float(m.group(5)) * \
                 (1000 if m.group(4) == 'km' else 1609.34)
+        self.cats = POINTS_CATS
+        if m.group(6):
+            self.cats = tuple(m.group(6).upper())
+            if not set(self.cats) <= set(POINTS_CATS):
+                sys.exit('Unknown category in points info "%s"' % val)
 
 
 class config():
     def __init__(self, fname):
+        self.file               = fname
         self.id                 = None
         self.name               = None
         self.start_ms           = None
@@ -1020,6 +2330,8 @@ class config():
         self.start_window_ms    = min2ms(10.0)
         self.grp                = []        # category groups
         self.points             = []        # intermediate points
+        self.points_mode        = 'leader'
+        self.cat_rules          = []        # extra category rules
 
         self.init_kw(config.__dict__)
         self.parse(fname)
@@ -1099,7 +2411,19 @@ class config():
 
     @keyword('POINTS')
     def kw_points(self, val):
-        self.points.append(config_points(val))
+        p = config_points(val)
+        for q in self.points:
+            if (q.line, q.forward, q.distance) == \
+                    (p.line, p.forward, p.distance) and \
+                    set(q.cats) & set(p.cats):
+                sys.exit('Duplicate points info "%s"' % val)
+        self.points.append(p)
+
+    @keyword('POINTS_MODE')
+    def kw_points_mode(self, val):
+        if val not in POINTS_MODES:
+            sys.exit('Unknown points mode "%s"' % val)
+        self.points_mode = val
 
     @keyword('POINTS_FINAL')
     def kw_points_final(self, val):
@@ -1146,6 +2470,14 @@ class config():
         if 'time' in d:
             self.cutoff_ms = strT_to_sec(d['time']) * 60 * 1000
 
+    #
+    # Extra rule for detecting the category from rider names, tried
+    # before the built in rules.  Group 1 is the category letter.
+    #
+    @keyword('CAT_RULE')
+    def kw_cat_rule(self, val):
+        self.cat_rules.append(val)
+
     @keyword('CAT')
     def kw_cat(self, val):
         (name, val) = val.split(None, 1)
@@ -1175,6 +2507,7 @@ class config():
         else:
             self.finish_ms = self.start_ms + ((2 * 3600) * 1000)
         self.lookback_ms = max(self.lookback_ms, self.grace_ms)
+        self.cat_detect = cat_rules(self.cat_rules + CAT_RULES)
 
     def parse_line(self, val):
         m = re.match('{\s+(.*)\s+}', val)
@@ -1246,10 +2579,10 @@ SUFFIX='''
 #
 # HTTP output function.
 #  Takes a template (in json format) describing the database,
-#  and the unfiltered rider list.
+#  and the rider standings.
 #  Creates the database if it does not exist.
 #
-def http(T, F):
+def http(T, S):
 
     print PREFIX
 #    print TITLE
@@ -1259,17 +2592,14 @@ def http(T, F):
 
     hdr = [ f['name'] for f in T['fields'] ]
     cls = [ d['class'] if 'class' in d else '' for d in T['fields'] ]
-    fld = [ f['value'] for f in T['fields'] ]
-
-    dnf = set([ r for r in F if r.dnf ])
-    dq  = set([ r for r in F if r.dq ])
-    finish = set(F) - dnf - dq
+    fld = field_getters(T)
 
     colors = { 'A': 'red', 'B': 'yellow', 'C': 'green', 'D': 'violet',
                'W': 'pink', 'X': 'black' }
-    C = sorted(list(set([ r.cat for r in finish ])))
-    for cat in C:
-        L = [ r for r in finish if r.cat == cat ]
+    for cat in S.cats:
+        L = S.get(cat, 'finish')
+        if not L:
+            continue
 #        cat = cat if cat in 'ABCDW' else 'X'
 
         print '<h4 class="ui horizontal divider header">'
@@ -1282,7 +2612,7 @@ def http(T, F):
         print '</tr></thead><tbody>'
 
         for r in place(L):
-            val = [ str(r[k]) for k in fld ]
+            val = [ str(get(r)) for get in fld ]
             for idx, f in enumerate(val):
                 esc = f.replace(' ', '&nbsp')
                 print '<td%s>%s</td>' % (cls[idx], esc)
@@ -1293,118 +2623,197 @@ def http(T, F):
     print SUFFIX
 
 #
-# MySQL output function.
-#  Takes a template (in json format) describing the database
-#  and the unfiltered rider list.
-#  Creates the database if it does not exist.
-#
-#  XXX does not drop rows.... need to fix this.
+# Export of the finishers to a SQL table, for the mysql and sqlite
+#  output functions.  db is a DB-API connection, mark its parameter
+#  marker and has_table the query for whether the table exists.
+#  Creates the table if it does not exist, keyed on the ride_uuid
+#  field.  Then, in one transaction: deletes the rows of this race
+#  (ride_id) which are no longer in the results, updates the rows
+#  which are and inserts the rest, with executemany in EXPORT_ROWS
+#  batches.  Values keep their own types, None is NULL.
 #
-def mysql(T, F):
-    import MySQLdb
-
-    msql = MySQLdb.connect(user = T['user'], db = T['db'])
-    c = msql.cursor()
-
-    c.execute('show tables like %s;', (T['table'],))
+EXPORT_ROWS = 1000
+
+def sql_export(db, T, S, mark, has_table):
+    names = dict([ (f['value'], f['name']) for f in T['fields'] ])
+    if ('ride_id' not in names) or ('ride_uuid' not in names):
+        sys.exit('Output table needs ride_id and ride_uuid fields')
+    ride_id = names['ride_id']
+    key = names['ride_uuid']
+    table = T['table']
+
+    c = db.cursor()
+    c.execute(has_table, (table,))
     if not c.fetchone():
         fld = []
         for f in T['fields']:
             fld.append("%s %s" % (f['name'], f['type']))
-        sql = 'create table %s (%s);' % (T['table'], ', '.join(fld))
+        fld.append('unique (%s)' % key)
+        sql = 'create table %s (%s);' % (table, ', '.join(fld))
         c.execute(sql)
-        msql.commit()
+        db.commit()
 
     fld = [ f['name'] for f in T['fields'] ]
-    sql = 'insert into %s (%s) values (%s);' % \
-            (T['table'], ', '.join(fld),
-             ', '.join([ "%s" for f in fld]))
-
-    fld = [ f['value'] for f in T['fields'] ]
-    dnf = set([ r for r in F if r.dnf ])
-    dq  = set([ r for r in F if r.dq ])
-    finish = set(F) - dnf - dq
-    for r in place(finish):
-        val = [ str(r[k]) for k in fld ]
-        c.execute(sql, val)
-    msql.commit()
-    msql.close()
+    get = field_getters(T)
+    uuid = fld.index(key)
+    rows = [ [ g(r) for g in get ] for r in place(S.all('finish')) ]
+    race = conf.id + '.' + conf.date
 
+    try:
+        #
+        # Rows of this race already there, by key.  Keys found more
+        # than once (tables written before the key was unique) are
+        # deleted and inserted again.
+        #
+        c.execute('select %s from %s where %s = %s;' % (key, table,
+                ride_id, mark), (race,))
+        have = {}
+        for (k,) in c.fetchall():
+            have[k] = have.get(k, 0) + 1
+        keep = set([ row[uuid] for row in rows ])
+        drop = [ (k,) for k, n in have.iteritems()
+                if (k not in keep) or (n > 1) ]
+        U = [ row + [ row[uuid] ] for row in rows if have.get(row[uuid]) == 1 ]
+        I = [ row for row in rows if have.get(row[uuid]) != 1 ]
+
+        execute_rows(c, 'delete from %s where %s = %s;' % (table, key,
+                mark), drop)
+        execute_rows(c, 'update %s set %s where %s = %s;' % (table,
+                ', '.join([ '%s = %s' % (f, mark) for f in fld ]),
+                key, mark), U)
+        execute_rows(c, 'insert into %s (%s) values (%s);' % (table,
+                ', '.join(fld), ', '.join([ mark for f in fld ])), I)
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+
+def execute_rows(c, sql, rows):
+    for n in xrange(0, len(rows), EXPORT_ROWS):
+        c.executemany(sql, rows[n : n + EXPORT_ROWS])
 
-global args
-global conf
-global dbh
-global name_dbh
 
-def main(argv):
-    global args
-    global conf
-    global dbh
-    global name_dbh
+#
+# MySQL output function.
+#  Takes a template (in json format) describing the database
+#  and the rider standings.
+#  Creates the table if it does not exist.
+#
+def mysql(T, S):
+    import MySQLdb
 
-    parser = argparse.ArgumentParser(description = 'Race Result Generator')
-    parser.add_argument('-j', '--json', action='store_true',
-            help='JSON output')
-    parser.add_argument('-s', '--split', action='store_true',
-            help='Generate split results')
-    parser.add_argument('-I', '--idlist', action='store_true',
-            help='List of IDs that need names')
-    parser.add_argument('-d', '--debug', action='store_true',
-            help='Debug things')
-    parser.add_argument('-i', '--ident', action='store_true',
-            help='Show Zwift identifiers')
-    parser.add_argument('-u', '--update_cat', action='store_true',
-            help='Update rider database with their estimated ride category')
-    parser.add_argument('-r', '--result_file', action='store_true',
-            help='Write results into correctly named file')
-    parser.add_argument('--database', default='race_database.sql3',
-            help='Specify source .sql3 database')
-    parser.add_argument('--output', help='Output format specification')
-    parser.add_argument('-n', '--no_cat', action='store_true',
-            help='Do not perform automatic category assignemnts from names')
-    parser.add_argument('config_file', help='Configuration file for race.')
-    args = parser.parse_args()
+    msql = MySQLdb.connect(user = T['user'], db = T['db'])
+    sql_export(msql, T, S, '%s', 'show tables like %s;')
+    msql.close()
 
-    #
-    # config needs to read the chalkline id's from the database, but
-    #  the database name is configurable.  Delay loading chalklines
-    #  until the after the configuration is parsed.
-    #
-    conf = config(args.config_file)
-    dbh = sqlite3.connect('file:%s?mode=ro' % args.database)
-    conf.load_chalklines()
 
-    name_dbh = sqlite3.connect('rider_names.sql3')
+#
+# SQLite output function, as mysql, to the database file T['file'].
+#
+def sqlite(T, S):
+    db = sqlite3.connect(T['file'])
+    db.text_factory = str
+    sql_export(db, T, S, '?',
+            "select name from sqlite_master where type = 'table'" +
+            " and name = ?;")
+    db.close()
 
-    if (args.debug):
-        print "START", 'fwd' if conf.start_forward else 'rev', \
-                conf.start_line_id, conf.start_line
-        print "FINISH", 'fwd' if conf.finish_forward else 'rev', \
-                conf.finish_line_id, conf.finish_line
 
-#    c = dbh.cursor()
-#    c.execute('select max(time_ms) from event where event = ?', ('STARTUP',));
-#    s = c.fetchone();
+#
+# Stage timing for --profile.
+#  Each stage records wall and CPU time, the peak RSS of the process
+#  when it finished, and the riders and position records it left.
+#  When disabled, stages cost nothing but the with statement.
+#
+class stage_timer():
+    def __init__(self, enabled):
+        self.enabled    = enabled
+        self.race       = ''
+        self.stages     = []
+
+    def stage(self, name):
+        return timed_stage(self, name)
+
+    def total(self):
+        return { 'race': '', 'stage': 'total',
+                'wall': sum([ s['wall'] for s in self.stages ]),
+                'cpu': sum([ s['cpu'] for s in self.stages ]),
+                'maxrss_kb': max_rss(), 'riders': None, 'rows': None }
+
+    def show(self, f):
+        f.write('%-8s %-16s %8s %8s %10s %7s %9s\n' % ('race', 'stage',
+                'wall', 'cpu', 'maxrss KB', 'riders', 'rows'))
+        for s in self.stages + [ self.total() ]:
+            f.write('%-8.8s %-16.16s %8.3f %8.3f %10s %7s %9s\n' % (
+                    s['race'], s['stage'], s['wall'], s['cpu'],
+                    '' if s['maxrss_kb'] is None else s['maxrss_kb'],
+                    '' if s['riders'] is None else s['riders'],
+                    '' if s['rows'] is None else s['rows']))
+
+    def dump(self, fname):
+        f = open(fname, 'w')
+        json.dump({ 'stages': self.stages, 'total': self.total() }, f,
+                indent = 1)
+        f.write('\n')
+        f.close()
+
+
+class timed_stage():
+    def __init__(self, timer, name):
+        self.timer      = timer
+        self.name       = name
+        self.riders     = None
+        self.rows       = None
+
+    # riders (a list or dict of them) left by the stage.
+    def count(self, F):
+        if self.timer.enabled:
+            if isinstance(F, dict):
+                F = F.values()
+            self.riders = len(F)
+            self.rows = sum([ len(r.pos) for r in F ])
+
+    def __enter__(self):
+        if self.timer.enabled:
+            self.wall = time.time()
+            self.cpu = time.clock()
+        return self
+
+    def __exit__(self, type, value, tb):
+        if self.timer.enabled and (type is None):
+            self.timer.stages.append({ 'race': self.timer.race,
+                    'stage': self.name,
+                    'wall': time.time() - self.wall,
+                    'cpu': time.clock() - self.cpu,
+                    'maxrss_kb': max_rss(),
+                    'riders': self.riders, 'rows': self.rows })
+        return False
 
-    if (args.debug):
-        print('time: %s .. %s' %
-                (time.ctime(conf.start_ms / 1000),
-                time.ctime(conf.finish_ms / 1000)))
-        print('time: [%d .. %d]' % (conf.start_ms, conf.finish_ms))
 
-    R, all_pos = get_riders(conf.start_ms - conf.lookback_ms, conf.finish_ms)
-    if (args.debug):
-        print 'Selected %d riders' % len(R)
+# peak RSS of the process so far, in KB.
+def max_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss / 1024                    # bytes on Mac
+    return rss
+
+prof = stage_timer(False)
 
-    #
-    # Cut rider list down to only those who crossed the start line
-    # in the correct direction from the time the race started.
-    #
-    F = R.values()
-    F = [ r for r in F if filter_start(r) ]
 
+#
+# Everything after the position records are read: rider info, the
+# per-rider stages that were not done while reading, finish selection
+# and points.  Returns the riders and sprints for output, or None when
+# only the id list was wanted.
+#
+def score_race(F, R):
     # pull names from the database.
-    [ rider_info(r) for r in F ]
+    with prof.stage('rider_info') as s:
+        rider_info(F)
+        s.count(F)
 
     #
     # dump list of riders needing their names fetched.
@@ -1415,35 +2824,38 @@ def main(argv):
 #        L = [ r.id for r in F if not r.has_info ]
         L = [ r.id for r in F ]
         print '\n'.join(map(str, L))
-        return
+        return None
 
     #
     # Filter out names without required tag.
     #
     if conf.required_tag is not None:
-        F = [r for r in F if filter_tag(r, conf.required_tag) ]
-
-    #
-    # Trim position records.
-    #
-    [ trim_course(r) for r in F ]
-    [ trim_crash(r) for r in F ]
+        with prof.stage('required_tag') as s:
+            F = [r for r in F if filter_tag(r, conf.required_tag) ]
+            s.count(F)
 
-    #
-    # Create cat result records.  Riders have records for every cat group.
-    #   If the rider's cat is known, the correct record is used.
-    #   When autodetecting cat, the highest weighted finish record is used.
-    #
-    for grp in conf.grp:
-        if (grp.lead is not None) and (grp.lead in R):
-            grp.starter = R[grp.lead]
-            grp.start_ms = grp.starter.pos[0].time_ms
-        elif grp.delay_ms is not None:
-            grp.start_ms = conf.start_ms + grp.delay_ms
-        else:
-            grp.start_ms = conf.start_ms
+    if not (args.stream or args.live or (args.jobs > 1)):
+        #
+        # Trim position records.
+        #
+        with prof.stage('trim_course') as s:
+            [ trim_course(r) for r in F ]
+            s.count(F)
+        with prof.stage('trim_crash') as s:
+            [ trim_crash(r) for r in F ]
+            s.count(F)
 
-        [ grp_finish(r, grp) for r in F ]
+        #
+        # Create cat result records.  Riders have records for every cat
+        #   group.  If the rider's cat is known, the correct record is used.
+        #   When autodetecting cat, the highest weighted finish record
+        #   is used.
+        #
+        with prof.stage('grp_finish') as s:
+            set_grp_start(R)
+            for grp in conf.grp:
+                [ grp_finish(r, grp) for r in F ]
+            s.count(F)
 
     #
     # Set rider cat here, in order to select the correct finish record.
@@ -1455,37 +2867,441 @@ def main(argv):
     #  this also creates the ride summary information for the finish,
     #  but not the ride placement.
     #
-    [ select_finish(r) for r in F ]
+    with prof.stage('select_finish') as s:
+        [ select_finish(r) for r in F ]
+        s.count(F)
+    with prof.stage('summarize'):
+        summarize(F)
 
     sprints = None
     if conf.points:
-        sprints = calculate_points(all_pos, conf.points, conf.points_final)
+        with prof.stage('calculate_points'):
+            sprints = calculate_points(F, conf.points, conf.points_final,
+                    conf.points_mode)
+
+    return F, sprints
+
 
+def output_race(F, sprints):
+    S = standings(F)
+    stdout = sys.stdout
     if (args.result_file):
         fname = conf.id + '.' + conf.date
-        fname += '.json' if args.json else '.txt'
+        if (args.ndjson):
+            fname += '.ndjson'
+        else:
+            fname += '.json' if args.json else '.txt'
         print "Writing results to %s" % fname
         sys.stdout = open(fname, 'w')
 
-    if (args.output):
-        f = open(args.output, "r")
+    try:
+        if (args.output):
+            f = open(args.output, "r")
+            try:
+                out = json.load(f)
+            except ValueError, se:
+                sys.exit('"%s": %s' % (args.output, se))
+            f.close
+            if 'output' not in out or \
+                    out['output'] not in globals():
+                sys.exit('Unknown output function.')
+            f = globals()[out['output']]
+            f(out, S)
+            print "Completed output for %s" % (args.output)
+        elif (args.json):
+            dump_json(conf.id, conf.start_ms, S, sprints)
+        else:
+            results(conf.id, S)
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    #
+    # after the normal output: like dump_json, this moves the DQ and
+    # DNF riders' end to their last record.
+    #
+    if (args.binary):
+        fname = conf.id + '.' + conf.date + '.bin'
+        if (args.result_file):
+            print "Writing binary results to %s" % fname
+        dump_binary(fname, conf.id, S, sprints)
+
+
+def show_window():
+    if (args.debug):
+        print "START", 'fwd' if conf.start_forward else 'rev', \
+                conf.start_line_id, conf.start_line
+        print "FINISH", 'fwd' if conf.finish_forward else 'rev', \
+                conf.finish_line_id, conf.finish_line
+        print('time: %s .. %s' %
+                (time.ctime(conf.start_ms / 1000),
+                time.ctime(conf.finish_ms / 1000)))
+        print('time: [%d .. %d]' % (conf.start_ms, conf.finish_ms))
+
+
+#
+# Result cache, for --cache.
+#  What score_race() works out for a race is kept in DIR/ID.DATE.cache
+#  and reused by later runs, e.g. for other output formats, while
+#  nothing it depends on has changed: the config file, the options
+#  which change the scoring, the pos rows in the race window (count
+#  and highest rowid) and the name records of the riders who started.
+#  The file holds two pickles: the key, and then the riders as plain
+#  values, with their position window as the column bytes.
+#
+CACHE_VERSION   = 2
+
+POS_RANGE_SQL = 'select count(*), max(rowid) from pos' + \
+        ' where time_ms between ? and ?'
+
+def cache_file():
+    return os.path.join(args.cache, '%s.%s.cache' % (conf.id, conf.date))
+
+
+def race_key():
+    h = hashlib.sha1()
+    f = open(conf.file)
+    h.update(f.read())
+    f.close()
+    h.update(repr((CACHE_VERSION, args.no_cat)))
+    c = dbh.cursor()
+    h.update(repr(c.execute(POS_RANGE_SQL, (conf.start_ms - conf.lookback_ms,
+            conf.finish_ms)).fetchone()))
+    return h.hexdigest()
+
+
+def names_key(ids):
+    h = hashlib.sha1()
+    c = name_dbh.cursor()
+    ids = sorted(ids)
+    for n in xrange(0, len(ids), SQL_CHUNK):
+        chunk = ids[n : n + SQL_CHUNK]
+        h.update(repr(c.execute('select * from rider where rider_id in' +
+                ' (%s) order by rider_id' % ','.join('?' * len(chunk)),
+                chunk).fetchall()))
+    return h.hexdigest()
+
+
+RIDER_STATE = ( 'end_time', 'dq_time', 'dq_reason', 'distance', 'points',
+        'dnf', 'dq', 'has_info', 'fname', 'lname', 'cat', 'weight', 'height',
+        'age', 'male', '_power', 'power', 'name', 'mwh', 'meters', 'msec',
+        'watts', 'wkg', 'km', 'pace', 'ecat' )
+
+#
+# Store the riders F and sprints from score_race(), for a race whose
+# starters were `started'.  Written to a temporary file and renamed,
+# so an interrupted run leaves no partial cache.
+#
+def save_cache(F, sprints, started):
+    G = [ (grp.start_ms, grp.starter and grp.starter.id,
+            grp.starter and grp.starter.name) for grp in conf.grp ]
+    riders = [ (r.id, r.pos.cols.take(slice(r.pos.lo, r.pos.hi)).tostrings(),
+            None if r.end is None else r.end.idx - r.pos.lo,
+            conf.grp.index(r.grp),
+            [ getattr(r, k) for k in RIDER_STATE ]) for r in F ]
+    if sprints is not None:
+        sprints = dict([ (cat, [ (None if s.line is None else
+                conf.points.index(s.line), [ (points, r.id, gap_ms)
+                for (points, r, gap_ms) in s.results ]) for s in S ])
+                for cat, S in sprints.iteritems() ])
+
+    if not os.path.isdir(args.cache):
+        os.makedirs(args.cache)
+    fname = cache_file()
+    f = open(fname + '.tmp', 'wb')
+    cPickle.dump({ 'version': CACHE_VERSION, 'key': race_key(),
+            'started': started, 'names': names_key(started) }, f, 2)
+    cPickle.dump({ 'grp': G, 'riders': riders, 'sprints': sprints }, f, 2)
+    f.close()
+    os.rename(fname + '.tmp', fname)
+
+
+#
+# The riders and sprints kept by save_cache(), or None when there are
+# none or they are out of date.
+#
+def load_cache():
+    try:
+        f = open(cache_file(), 'rb')
+    except IOError:
+        return None
+    try:
+        k = cPickle.load(f)
+        if (k.get('version') != CACHE_VERSION) or \
+                (k['key'] != race_key()) or \
+                (k['names'] != names_key(k['started'])):
+            return None
+        c = cPickle.load(f)
+    except Exception:
+        return None
+    finally:
+        f.close()
+
+    F = []
+    R = {}
+    for (id, cols, end, grp, state) in c['riders']:
+        r = R[id] = rider(id)
+        p = pos_columns()
+        p.fromstrings(cols)
+        r.pos = pos_list(p)
+        r.end = None if end is None else r.pos.at(end)
+        r.grp = conf.grp[grp]
+        for k, v in izip(RIDER_STATE, state):
+            setattr(r, k, v)
+        F.append(r)
+
+    for grp, (start_ms, id, name) in izip(conf.grp, c['grp']):
+        grp.start_ms = start_ms
+        grp.starter = R.get(id)
+        if (id is not None) and (grp.starter is None):
+            grp.starter = rider(id)
+            grp.starter.name = name
+
+    sprints = c['sprints']
+    if sprints is not None:
+        sprints = dict([ (cat, [ sprint(None if n is None else conf.points[n],
+                [ (points, R[id], gap_ms) for (points, id, gap_ms) in L ])
+                for (n, L) in S ]) for cat, S in sprints.iteritems() ])
+    return F, sprints
+
+
+#
+# Several races from the same logger session.
+#  The position records for the union of the race windows are read
+#  once, then each race is scored from its own window of them, with
+#  conf switched to that race.
+#
+def batch_results(C):
+    global conf
+
+    begin_ms = min([ c.start_ms - c.lookback_ms for c in C ])
+    end_ms = max([ c.finish_ms for c in C ])
+    with prof.stage('get_riders') as s:
+        R = get_riders(begin_ms, end_ms)
+        s.count(R)
+    if (args.debug):
+        print 'Selected %d riders for %d races' % (len(R), len(C))
+
+    for conf in C:
+        prof.race = conf.id
+        show_window()
+        with prof.stage('window_riders') as s:
+            W = window_riders(R, conf.start_ms - conf.lookback_ms,
+                    conf.finish_ms)
+            s.count(W)
+        if (args.debug):
+            print 'Selected %d riders' % len(W)
+
+        if (args.jobs > 1):
+            with prof.stage('pool_riders') as s:
+                F = pool_riders(W)
+                s.count(F)
+        else:
+            with prof.stage('filter_start') as s:
+                F = [ r for r in W.values() if filter_start(r) ]
+                s.count(F)
+        v = score_race(F, W)
+        if v is not None:
+            with prof.stage('output'):
+                output_race(*v)
+
+
+global args
+global conf
+global dbh
+global name_dbh
+
+def main(argv):
+    global args
+    global prof
+
+    parser = argparse.ArgumentParser(description = 'Race Result Generator')
+    parser.add_argument('-j', '--json', action='store_true',
+            help='JSON output')
+    parser.add_argument('--ndjson', action='store_true',
+            help='Newline delimited JSON output, one result per line')
+    parser.add_argument('--binary', action='store_true',
+            help='Also write binary results, see binresults.py')
+    parser.add_argument('-s', '--split', action='store_true',
+            help='Generate split results')
+    parser.add_argument('-I', '--idlist', action='store_true',
+            help='List of IDs that need names')
+    parser.add_argument('-d', '--debug', action='store_true',
+            help='Debug things')
+    parser.add_argument('-i', '--ident', action='store_true',
+            help='Show Zwift identifiers')
+    parser.add_argument('-u', '--update_cat', action='store_true',
+            help='Update rider database with their estimated ride category')
+    parser.add_argument('-r', '--result_file', action='store_true',
+            help='Write results into correctly named file')
+    parser.add_argument('--database', default='race_database.sql3',
+            help='Specify source .sql3 database')
+    parser.add_argument('--output', help='Output format specification')
+    parser.add_argument('--prepare-db', action='store_true',
+            help='Check the database schema and create missing indexes')
+    parser.add_argument('--stream', action='store_true',
+            help='Read and trim riders one at a time, to save memory')
+    parser.add_argument('--live', action='store_true',
+            help='Follow the race as it is logged, showing standings')
+    parser.add_argument('--interval', type=float, default=10,
+            help='Seconds between live updates')
+    parser.add_argument('--cache', metavar='DIR',
+            help='Keep the computed results in DIR, and reuse them while' +
+            ' the config, positions and names are unchanged')
+    parser.add_argument('--shards', type=int, default=1,
+            help='Processes to read large position windows with')
+    parser.add_argument('--jobs', type=int, default=1,
+            help='Processes for the per-rider stages (not with --stream,' +
+            ' --live or --debug)')
+    parser.add_argument('-n', '--no_cat', action='store_true',
+            help='Do not perform automatic category assignemnts from names')
+    parser.add_argument('--profile', action='store_true',
+            help='Show time, CPU, peak RSS and counts for each stage')
+    parser.add_argument('--profile-json', metavar='FILE',
+            help='Write the --profile stage timings to FILE as JSON')
+    parser.add_argument('--cprofile', metavar='FILE',
+            help='Write cProfile statistics to FILE, see pstats')
+    parser.add_argument('config_file', nargs='+',
+            help='Configuration file for race.  With several, the races' +
+            ' are scored from one read of the database, into result files')
+    args = parser.parse_args()
+    if (args.ndjson):
+        args.json = True
+    if (args.jobs < 1) or (args.shards < 1):
+        sys.exit('--jobs and --shards must be at least 1')
+    if args.stream or args.live or args.debug or not hasattr(os, 'fork'):
+        # workers are forked with the riders, and debug output would
+        # be interleaved.
+        args.jobs = 1
+        args.shards = 1
+
+    prof = stage_timer(args.profile or (args.profile_json is not None))
+    if (args.cprofile):
+        cprof = cProfile.Profile()
         try:
-            out = json.load(f)
-        except ValueError, se:
-            sys.exit('"%s": %s' % (args.output, se))
-        f.close
-        if 'output' not in out or \
-                out['output'] not in globals():
-            sys.exit('Unknown output function.')
-        f = globals()[out['output']]
-        f(out, F)
-        print "Completed output for %s" % (args.output)
+            cprof.runcall(run, args.config_file)
+        finally:
+            cprof.dump_stats(args.cprofile)
+    else:
+        run(args.config_file)
+
+    # after the results, and not on stdout, which may be JSON.
+    if (args.profile):
+        prof.show(sys.stderr)
+    if (args.profile_json):
+        prof.dump(args.profile_json)
+
+
+def run(files):
+    global conf
+    global dbh
+    global name_dbh
+
+    #
+    # config needs to read the chalkline id's from the database, but
+    #  the database name is configurable.  Delay loading chalklines
+    #  until the after the configuration is parsed.
+    #
+    with prof.stage('config'):
+        C = [ config(fname) for fname in files ]
+    if (args.prepare_db):
+        prepare_db(args.database,
+                min([ c.start_ms - c.lookback_ms for c in C ]),
+                max([ c.finish_ms for c in C ]))
         return
+    if len(C) > 1:
+        if (args.stream or args.live):
+            sys.exit('--stream and --live take a single config file')
+        # each race needs its own output.
+        args.result_file = True
+
+    dbh = sqlite3.connect('file:%s?mode=ro' % args.database)
+    with prof.stage('chalklines'):
+        for c in C:
+            c.load_chalklines()
+
+    name_dbh = sqlite3.connect('rider_names.sql3')
 
-    if (args.json):
-        dump_json(conf.id, conf.start_ms, F, sprints)
+    if len(C) > 1:
+        batch_results(C)
+        dbh.close()
+        name_dbh.close()
+        return
+
+    conf = C[0]
+    show_window()
+
+    #
+    # Results are reused while nothing they depend on changes.  Not
+    # with --stream, which may drop records, or with -I and -u, which
+    # are for fixing up the names.
+    #
+    cache = args.cache and not (args.stream or args.live or args.idlist or
+            args.update_cat)
+    if cache:
+        with prof.stage('load_cache'):
+            v = load_cache()
+        if v is not None:
+            if (args.debug):
+                print 'Using cached results from %s' % cache_file()
+            with prof.stage('output'):
+                output_race(*v)
+            dbh.close()
+            name_dbh.close()
+            return
+
+#    c = dbh.cursor()
+#    c.execute('select max(time_ms) from event where event = ?', ('STARTUP',));
+#    s = c.fetchone();
+
+    R = None
+    if (args.live):
+        with prof.stage('live_results') as s:
+            F = live_results(conf.start_ms - conf.lookback_ms,
+                    conf.finish_ms, args.interval)
+            s.count(F)
+    elif (args.stream):
+        #
+        # start, course, crash and finish stages are done per rider
+        # as the riders are read.
+        #
+        with prof.stage('stream_riders') as s:
+            F = stream_riders(conf.start_ms - conf.lookback_ms,
+                    conf.finish_ms)
+            s.count(F)
+        if (args.debug):
+            print 'Selected %d riders' % len(F)
     else:
-        results(conf.id, F)
+        with prof.stage('get_riders') as s:
+            R = get_riders(conf.start_ms - conf.lookback_ms,
+                    conf.finish_ms)
+            s.count(R)
+        if (args.debug):
+            print 'Selected %d riders' % len(R)
+
+        #
+        # Cut rider list down to only those who crossed the start line
+        # in the correct direction from the time the race started.
+        #
+        if (args.jobs > 1):
+            with prof.stage('pool_riders') as s:
+                F = pool_riders(R)
+                s.count(F)
+        else:
+            with prof.stage('filter_start') as s:
+                F = R.values()
+                F = [ r for r in F if filter_start(r) ]
+                s.count(F)
+
+    started = [ r.id for r in F ]
+    v = score_race(F, R)
+    if v is not None:
+        if cache:
+            with prof.stage('save_cache'):
+                save_cache(v[0], v[1], started)
+        with prof.stage('output'):
+            output_race(*v)
 
     dbh.close()
     name_dbh.close()
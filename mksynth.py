@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+#
+# Synthetic race database generator.
+#
+#  Writes a race_database.sql3 / rider_names.sql3 pair with the same
+#  tables that mkresults reads (pos, chalkline, rider), along with a
+#  matching race configuration file.  Used for benchmarking without
+#  a real zlogger capture.
+#
+#  Optionally a fraction of the riders crash (the game restarts and
+#  the ride counters go back to zero), jump the start, or turn around
+#  and ride the course backwards.  These are drawn from a separate
+#  random stream, so without them the output is unchanged.
+#   ./mksynth.py -n 1000 -l 3 --crashes 0.02 --early 0.05 \
+#       --wrong-course 0.02 --config race.conf
+#
+import sys, argparse
+import sqlite3
+import os, time
+import random
+
+global args
+
+LAP_METERS      = 16 * 1000             # 1 lap of richmond = 16.09km
+
+FNAMES = [ 'Alex', 'Sam', 'Chris', 'Pat', 'Jo', 'Robin', 'Kim', 'Lee',
+           'Max', 'Noel', 'Dana', 'Jesse', 'Toni', 'Remy', 'Ari' ]
+LNAMES = [ 'Smith', 'Jones', 'Brown', 'Lemon', 'Miller', 'Davis', 'Moore',
+           'Clark', 'Walker', 'Young', 'King', 'Wright', 'Hill', 'Green' ]
+
+#
+# Name tags used by riders to declare their category.
+#  See rider.set_info() for the matching rules.
+#
+TAGS = [ '(%s)', '%s', 'KISS-%s', '(KISS %s)', 'KISS-%s) TEAM',
+         '(%s) TEAM', 'KISS %s) TEAM', '' ]
+
+
+def create_race_db(fname):
+    if os.path.exists(fname):
+        os.unlink(fname)
+    dbh = sqlite3.connect(fname)
+    c = dbh.cursor()
+    c.execute('create table chalkline (line_id integer primary key,' +
+            ' name text)')
+    c.execute('create table pos (rider_id integer, time_ms integer,' +
+            ' line_id integer, forward integer, meters integer,' +
+            ' mwh integer, duration integer, elevation integer,' +
+            ' speed integer, hr integer)')
+    return dbh
+
+
+def create_name_db(fname):
+    if os.path.exists(fname):
+        os.unlink(fname)
+    dbh = sqlite3.connect(fname)
+    c = dbh.cursor()
+    c.execute('create table rider (rider_id integer primary key,' +
+            ' fname text, lname text, cat text, age integer,' +
+            ' weight integer, height integer, male integer,' +
+            ' zpower integer, fetched_at text)')
+    return dbh
+
+
+#
+# Chalklines are evenly spaced around the lap.  Line 1 is the start
+# and finish line.
+#
+def make_lines(dbh):
+    lines = []
+    for idx in range(args.lines):
+        name = 'Synthetic Line %d' % (idx + 1)
+        offset = (LAP_METERS * idx) / args.lines
+        dbh.execute('insert into chalkline (line_id, name) values (?,?)',
+                (idx + 1, name))
+        lines.append((idx + 1, name, offset))
+    return lines
+
+
+#
+# Generate the line crossings for one rider.
+#  The rider rolls around for a while before the start, crosses the
+#  start line at start_ms and then rides at a constant pace.
+#  After `turn' meters the rider rides the course backwards, crossing
+#  lines in reverse.  After `crash' meters the ride counters restart
+#  from zero.
+#
+def ride(rid, start_ms, kmh, watts, lines, distance, turn = None,
+        crash = None):
+    v = (kmh * 1000.0) / (3600 * 1000)          # meters per msec
+    m0 = random.randint(0, 200 * 1000)
+    w0 = random.randint(0, 2000 * 1000)
+    d0 = random.randint(0, 3600)
+    hr = random.randint(100, 130)
+    pre = random.randint(500, LAP_METERS / 2)
+    end = distance + LAP_METERS / 2
+
+    #
+    # (distance ridden, line, forward) for each crossing.
+    #
+    X = []
+    laps = (distance + LAP_METERS) / LAP_METERS + 2
+    for lap in range(-1, laps):
+        for (line_id, name, offset) in lines:
+            d = (lap * LAP_METERS) + offset
+            if (d < -pre) or (d > end):
+                continue
+            if (turn is not None) and (d > turn):
+                continue
+            X.append((d, line_id, 1))
+    if turn is not None:
+        # position on the course is 2 * turn - d
+        for k in range(-laps, laps):
+            for (line_id, name, offset) in lines:
+                d = 2 * turn - offset - k * LAP_METERS
+                if (turn < d <= end):
+                    X.append((d, line_id, 0))
+        X.sort()
+
+    rows = []
+    for (d, line_id, forward) in X:
+        msec = int((d + pre) / v)
+        t = start_ms + int(d / v)
+        hr = min(190, hr + random.randint(0, 3))
+        (meters, mwh, duration) = (m0 + pre + d,
+                w0 + int(watts * msec / 3600), d0 + msec / 1000)
+        if (crash is not None) and (d > crash):
+            msec = int((d - crash) / v)
+            (meters, mwh, duration) = (int(d - crash),
+                    int(watts * msec / 3600), msec / 1000)
+        rows.append((rid, t, line_id, forward, meters, mwh, duration,
+                random.randint(0, 50), int(kmh * 1000 * 1000), hr))
+    return rows
+
+
+def make_riders(dbh, name_dbh, lines):
+    distance = args.laps * LAP_METERS
+    start_ms = args.start * 1000
+    incident = random.Random(args.seed + 1)
+    rows = []
+    for idx in range(args.riders):
+        rid = 1000 + idx
+        cat = random.choice('ABCD')
+        male = random.random() > 0.2
+        weight = random.randint(55, 95) * 1000
+        wkg = { 'A': 4.3, 'B': 3.6, 'C': 2.9, 'D': 2.2 }[cat]
+        wkg = wkg + random.uniform(-0.3, 0.3)
+        watts = int(wkg * weight / 1000)
+        kmh = 25 + (wkg * 4) + random.uniform(-1, 1)
+        delay = random.randint(-20, 120) * 1000
+
+        #
+        # at most one incident per rider.  Early starters jump by
+        # more than the default grace, and less than the lookback.
+        #
+        (turn, crash) = (None, None)
+        x = incident.random()
+        if x < args.crashes:
+            crash = int(incident.uniform(0.1, 0.9) * distance)
+        elif x < args.crashes + args.wrong_course:
+            turn = int(incident.uniform(0.1, 0.9) * distance)
+        elif x < args.crashes + args.wrong_course + args.early:
+            delay = -incident.randint(30, 110) * 1000
+
+        rows.extend(ride(rid, start_ms + delay, kmh, watts, lines, distance,
+                turn, crash))
+
+        tag = random.choice(TAGS)
+        lname = random.choice(LNAMES)
+        if tag:
+            lname = lname + ' ' + (tag % cat)
+        name_dbh.execute('insert into rider (rider_id, fname, lname, cat,' +
+                ' age, weight, height, male, zpower, fetched_at)' +
+                ' values (?,?,?,?,?,?,?,?,?,date(\'now\'))',
+                (rid, random.choice(FNAMES), lname,
+                cat if random.random() < 0.3 else None,
+                random.randint(18, 70), weight, random.randint(1550, 1950),
+                1 if male else 0, random.randint(1, 3)))
+
+    #
+    # The logger writes records as they are seen.
+    #
+    rows.sort(key = lambda v: v[1])
+    dbh.executemany('insert into pos (rider_id, time_ms, line_id, forward,' +
+            ' meters, mwh, duration, elevation, speed, hr)' +
+            ' values (?,?,?,?,?,?,?,?,?,?)', rows)
+    return len(rows)
+
+
+def write_config(fname):
+    t = time.localtime(args.start)
+    f = open(fname, 'w')
+    f.write('ID SYN\n')
+    f.write('NAME Synthetic Race\n')
+    f.write('START fwd { Synthetic Line 1 }\n')
+    f.write('FINISH fwd { Synthetic Line 1 }\n')
+    f.write('BEGIN date %s time %s zone local\n' % (
+            time.strftime('%Y-%m-%d', t), time.strftime('%H:%M', t)))
+    f.write('CUTOFF pace 20\n')
+    f.write('CAT all { delay 0:00 } km %d\n' % (
+            args.laps * LAP_METERS / 1000))
+    f.close()
+
+
+def main(argv):
+    global args
+
+    parser = argparse.ArgumentParser(
+            description = 'Synthetic Race Database Generator')
+    parser.add_argument('-n', '--riders', type=int, default=100,
+            help='Number of riders')
+    parser.add_argument('-l', '--laps', type=int, default=2,
+            help='Race length in laps')
+    parser.add_argument('--lines', type=int, default=4,
+            help='Number of chalklines around the lap')
+    parser.add_argument('--start', type=int, default=1467910800,
+            help='Race start time (unix seconds, on the minute)')
+    parser.add_argument('--crashes', type=float, default=0.0,
+            help='Fraction of riders whose game crashes mid race')
+    parser.add_argument('--early', type=float, default=0.0,
+            help='Fraction of riders who jump the start')
+    parser.add_argument('--wrong-course', type=float, default=0.0,
+            help='Fraction of riders who turn around mid race')
+    parser.add_argument('--seed', type=int, default=1,
+            help='Random seed')
+    parser.add_argument('--config', help='Write race configuration file')
+    parser.add_argument('--names', default='rider_names.sql3',
+            help='Rider name database to create')
+    parser.add_argument('database', nargs='?', default='race_database.sql3',
+            help='Race database to create')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    dbh = create_race_db(args.database)
+    name_dbh = create_name_db(args.names)
+    lines = make_lines(dbh)
+    count = make_riders(dbh, name_dbh, lines)
+    dbh.commit()
+    name_dbh.commit()
+    dbh.close()
+    name_dbh.close()
+
+    if args.config:
+        write_config(args.config)
+
+    print 'Wrote %d riders, %d position records' % (args.riders, count)
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except KeyboardInterrupt:
+        pass
+    except SystemExit, se:
+        print "ERROR:", se
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# Local stand-in for the Zwift login and profile servers.
+#
+#  Serves the token, logout and /api/profiles/<id> endpoints used by
+#  get_riders.py, with made up profiles.  Can add latency and
+#  throttle responses, to exercise the concurrent fetch and backoff.
+#   ./zwift_stub.py -p 8000 --delay 50 --throttle 0.1 &
+#   ./get_riders.py --auth http://localhost:8000 \
+#       --api http://localhost:8000 -u test 1000 1001 1002
+#
+import sys, argparse
+import json
+import re
+import time
+import random
+import threading
+import BaseHTTPServer, SocketServer
+
+global args
+
+FNAMES = [ 'Alex', 'Sam', 'Chris', 'Pat', 'Jo', 'Robin', 'Kim', 'Lee' ]
+LNAMES = [ 'Smith (A)', 'Jones B', 'Brown KISS-C', 'Lemon (KISS D)',
+           'Miller', 'Davis (B) TEAM' ]
+POWER = [ 'zPower', 'Smart Trainer', 'Power Meter' ]
+
+lock = threading.Lock()
+count = { 'profiles': 0, 'throttled': 0 }
+
+
+def profile(id):
+    g = random.Random(id)
+    return {
+        'id': id,
+        'firstName': g.choice(FNAMES) + ' ',
+        'lastName': g.choice(LNAMES),
+        'age': g.randint(18, 70),
+        'weight': g.randint(55, 95) * 1000,
+        'height': g.randint(1550, 1950),
+        'male': g.random() > 0.2,
+        'powerSourceModel': g.choice(POWER),
+    }
+
+
+class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def reply(self, code, body = None, headers = {}):
+        self.send_response(code)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        data = json.dumps(body) if body is not None else ''
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        n = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(n)
+        if self.path.endswith('/tokens/access/codes'):
+            self.reply(200, { 'access_token': 'stub-access',
+                    'refresh_token': 'stub-refresh', 'expires_in': 3600 })
+        elif self.path.endswith('/tokens/logout'):
+            self.reply(204)
+        else:
+            self.reply(404, { 'error': self.path })
+
+    def do_GET(self):
+        m = re.match('/api/profiles/(\d+)$', self.path)
+        if not m:
+            self.reply(404, { 'error': self.path })
+            return
+        if args.delay:
+            time.sleep(args.delay / 1000.0)
+        if random.random() < args.throttle:
+            with lock:
+                count['throttled'] += 1
+            self.reply(429, { 'error': 'slow down' },
+                    { 'Retry-After': '%.2f' % args.retry_after })
+            return
+        with lock:
+            count['profiles'] += 1
+        self.reply(200, profile(int(m.group(1))))
+
+    def log_message(self, format, *v):
+        if args.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                    self, format, *v)
+
+
+class server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def main(argv):
+    global args
+
+    parser = argparse.ArgumentParser(description = 'Zwift API stub server')
+    parser.add_argument('-p', '--port', type=int, default=8000,
+            help='Port to listen on')
+    parser.add_argument('--delay', type=int, default=0,
+            help='Latency added to each profile request (ms)')
+    parser.add_argument('--throttle', type=float, default=0.0,
+            help='Fraction of profile requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=0.1,
+            help='Retry-After seconds sent with a 429')
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help='Log requests')
+    args = parser.parse_args()
+
+    httpd = server(('127.0.0.1', args.port), handler)
+    print 'Listening on http://127.0.0.1:%d' % args.port
+    try:
+        httpd.serve_forever()
+    finally:
+        print 'Served %d profiles, throttled %d' % (
+                count['profiles'], count['throttled'])
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except KeyboardInterrupt:
+        pass
+    except SystemExit, se:
+        print "ERROR:", se